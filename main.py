@@ -4,34 +4,43 @@ Asistente de chat inteligente con procesamiento de lenguaje natural
 """
 
 import os
+import sys
 import uvicorn
-from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-import json
+import orjson
 import asyncio
-from typing import List, Dict, Any
+import logging
 
 from src.api.chat import chat_router
 from src.api.websocket import websocket_router
-from src.core.config import settings
-from src.core.database import init_database
-from src.services.ai_service import AIService
-from src.services.ml_service import MLService
+from src.core.clock import run_clock
+from src.core.config import get_settings
+from src.core.database import db_manager, init_database
+from src.core.db_writer import start_writer, stop_writer
+from src.core.logger import setup_logging, shutdown_logging
+from src.services.ai_service import get_ai_service
+from src.services.ml_service import get_ml_service
+
+settings = get_settings()
 
 # Cargar variables de entorno
 load_dotenv()
 
+log = logging.getLogger("lenrodai")
+
 # Crear aplicación FastAPI
 app = FastAPI(
     title="AI Chat Assistant",
     description="Asistente de chat inteligente con procesamiento de lenguaje natural",
     version="1.0.0",
     docs_url="/api/docs",
-    redoc_url="/api/redoc"
+    redoc_url="/api/redoc",
+    default_response_class=ORJSONResponse
 )
 
 # Configurar CORS
@@ -53,99 +62,52 @@ templates = Jinja2Templates(directory="templates")
 app.include_router(chat_router, prefix="/api/chat", tags=["chat"])
 app.include_router(websocket_router, prefix="/ws", tags=["websocket"])
 
-# Inicializar servicios
-ai_service = AIService()
-ml_service = MLService()
-
-# Conexiones WebSocket activas
-active_connections: List[WebSocket] = []
-
 @app.on_event("startup")
 async def startup_event():
     """Inicializar la aplicación"""
-    print("🚀 Iniciando AI Chat Assistant...")
+    setup_logging()
+    log.info("Iniciando AI Chat Assistant...")
+    app.state.clock_task = asyncio.create_task(run_clock())
     await init_database()
-    await ai_service.initialize()
-    await ml_service.initialize()
-    print("✅ Aplicación iniciada correctamente")
+    # La plantilla no usa variables por petición: se lee una sola vez
+    with open("templates/index.html", "rb") as f:
+        app.state.index_html = f.read()
+    start_writer()
+    await get_ai_service().initialize()
+    await get_ml_service().initialize()
+    log.info("Aplicación iniciada correctamente")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cerrar la aplicación"""
-    print("🛑 Cerrando AI Chat Assistant...")
-    await ai_service.cleanup()
-    await ml_service.cleanup()
-    print("✅ Aplicación cerrada correctamente")
+    log.info("Cerrando AI Chat Assistant...")
+    app.state.clock_task.cancel()
+    await stop_writer()
+    db_manager.close()
+    await get_ai_service().cleanup()
+    await get_ml_service().cleanup()
+    log.info("Aplicación cerrada correctamente")
+    shutdown_logging()
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     """Página principal"""
-    return templates.TemplateResponse("index.html", {"request": request})
+    # En desarrollo se renderiza en cada petición para ver los cambios de la plantilla
+    if settings.DEBUG:
+        return templates.TemplateResponse("index.html", {"request": request})
+    return HTMLResponse(content=app.state.index_html)
+
+# Respuesta de salud inmutable, serializada una sola vez al importar
+HEALTH_BYTES = orjson.dumps({
+    "status": "healthy",
+    "message": "AI Chat Assistant is running",
+    "version": "1.0.0"
+})
 
 @app.get("/health")
 async def health_check():
     """Verificar estado de la aplicación"""
-    return {
-        "status": "healthy",
-        "message": "AI Chat Assistant is running",
-        "version": "1.0.0"
-    }
-
-@app.websocket("/ws/chat")
-async def websocket_endpoint(websocket: WebSocket):
-    """Endpoint WebSocket para chat en tiempo real"""
-    await websocket.accept()
-    active_connections.append(websocket)
-    
-    try:
-        while True:
-            # Recibir mensaje del cliente
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
-            
-            # Procesar mensaje con IA
-            response = await process_chat_message(message_data)
-            
-            # Enviar respuesta
-            await websocket.send_text(json.dumps(response))
-            
-    except WebSocketDisconnect:
-        active_connections.remove(websocket)
-    except Exception as e:
-        print(f"Error en WebSocket: {e}")
-        if websocket in active_connections:
-            active_connections.remove(websocket)
-
-async def process_chat_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Procesar mensaje de chat con IA"""
-    try:
-        user_message = message_data.get("message", "")
-        conversation_history = message_data.get("history", [])
-        
-        # Procesar con modelo de ML para contexto
-        context = await ml_service.analyze_context(user_message, conversation_history)
-        
-        # Generar respuesta con OpenAI
-        ai_response = await ai_service.generate_response(
-            user_message, 
-            conversation_history, 
-            context
-        )
-        
-        return {
-            "type": "response",
-            "message": ai_response["message"],
-            "confidence": ai_response.get("confidence", 0.8),
-            "context": context,
-            "timestamp": ai_response.get("timestamp")
-        }
-        
-    except Exception as e:
-        return {
-            "type": "error",
-            "message": f"Error procesando mensaje: {str(e)}",
-            "timestamp": None
-        }
+    return Response(content=HEALTH_BYTES, media_type="application/json")
 
 if __name__ == "__main__":
     uvicorn.run(
@@ -153,5 +115,15 @@ if __name__ == "__main__":
         host=settings.HOST,
         port=settings.PORT,
         reload=settings.DEBUG,
-        log_level="info"
+        # Uvicorn ignora workers con reload activo
+        workers=settings.WORKERS,
+        log_level="info",
+        access_log=False,
+        # uvloop no está disponible en Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets",
+        # Los frames de chat son pequeños: comprimir solo compensa con difusiones grandes
+        ws_per_message_deflate=settings.WS_COMPRESS,
+        ws_max_size=65536
     )
@@ -1,18 +1,27 @@
 import os
+import sys
+import logging
 import uvicorn
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-import json
+import orjson
+import msgspec
 from datetime import datetime
+from typing import Optional
 import asyncio
 
+from src.core.ws_frames import receive_payload
+
+logger = logging.getLogger(__name__)
+
 app = FastAPI(
     title="AI Chat Assistant",
     version="1.0.0",
-    docs_url="/api/docs"
+    docs_url="/api/docs",
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -26,57 +35,123 @@ app.add_middleware(
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
+# Máximo de mensajes que se agrupan en un solo frame WebSocket
+MAX_BATCH_SIZE = 32
+# Mensajes pendientes por conexión antes de descartar los más antiguos
+MAX_QUEUE_SIZE = 256
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.active_connections: set[WebSocket] = set()
+        self.out_queues: dict[WebSocket, asyncio.Queue] = {}
+        self.senders: dict[WebSocket, asyncio.Task] = {}
     
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
-        print(f"Conexión WebSocket establecida. Total: {len(self.active_connections)}")
+        self.active_connections.add(websocket)
+        queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
+        self.out_queues[websocket] = queue
+        self.senders[websocket] = asyncio.create_task(self._sender(websocket, queue))
+        logger.debug("Conexión WebSocket establecida. Total: %d", len(self.active_connections))
     
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        print(f"Conexión WebSocket cerrada. Total: {len(self.active_connections)}")
+        self.active_connections.discard(websocket)
+        self.out_queues.pop(websocket, None)
+        sender = self.senders.pop(websocket, None)
+        if sender is not None:
+            sender.cancel()
+        logger.debug("Conexión WebSocket cerrada. Total: %d", len(self.active_connections))
     
-    async def send_personal_message(self, message: str, websocket: WebSocket):
+    async def _sender(self, websocket: WebSocket, queue: asyncio.Queue):
+        """Enviar los mensajes encolados, agrupando en un frame los que ya estén listos"""
         try:
-            await websocket.send_text(message)
+            while True:
+                batch = [await queue.get()]
+                while not queue.empty() and len(batch) < MAX_BATCH_SIZE:
+                    batch.append(queue.get_nowait())
+                
+                if len(batch) == 1:
+                    await websocket.send_bytes(batch[0])
+                else:
+                    # Los mensajes ya vienen serializados: se concatenan como array JSON
+                    await websocket.send_bytes(b"[" + b",".join(batch) + b"]")
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"Error enviando mensaje personal: {e}")
+            logger.debug("Error enviando mensaje personal: %s", e)
             self.disconnect(websocket)
     
-    async def broadcast(self, message: str):
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                print(f"Error en broadcast: {e}")
-                disconnected.append(connection)
-        
-        for connection in disconnected:
-            self.disconnect(connection)
+    @staticmethod
+    def _enqueue(queue: asyncio.Queue, message: bytes):
+        # Si el cliente no consume, se descarta el mensaje más antiguo en vez de bloquear
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(message)
+    
+    async def send_personal_message(self, message: bytes, websocket: WebSocket):
+        queue = self.out_queues.get(websocket)
+        if queue is not None:
+            self._enqueue(queue, message)
+    
+    async def broadcast(self, payload: dict):
+        # Serializar una sola vez y compartir los mismos bytes entre todas las conexiones
+        data = orjson.dumps(payload)
+        # Cada conexión tiene su propia cola: un cliente lento no bloquea a los demás
+        for queue in self.out_queues.values():
+            self._enqueue(queue, data)
 
 manager = ConnectionManager()
 
+# Timestamp ISO compartido, refrescado en segundo plano para no formatearlo en cada mensaje
+TIMESTAMP_REFRESH_INTERVAL = 0.2
+CURRENT_ISO = datetime.now().isoformat()
+
+async def refresh_timestamp():
+    global CURRENT_ISO
+    while True:
+        CURRENT_ISO = datetime.now().isoformat()
+        await asyncio.sleep(TIMESTAMP_REFRESH_INTERVAL)
+
+# Plantilla del pong: solo se inserta el timestamp
+PONG_PREFIX = b'{"type":"pong","timestamp":"'
+PONG_SUFFIX = b'"}'
+
+@app.on_event("startup")
+async def startup_event():
+    app.state.timestamp_task = asyncio.create_task(refresh_timestamp())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.timestamp_task.cancel()
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.get("/health")
 async def health_check():
-    return {
+    # orjson formatea el datetime de forma nativa (mismo ISO 8601 que isoformat())
+    return ORJSONResponse(content={
         "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": datetime.now(),
         "active_connections": len(manager.active_connections)
-    }
+    })
+
+# Partes estáticas de la respuesta de chat: se comparten entre peticiones (no mutar)
+CHAT_CONTEXT = {
+    "message_count": 1,
+    "session_duration": 0,
+    "user_preferences": {"language": "es"}
+}
+CHAT_MODEL_INFO = {
+    "model": "fast-demo",
+    "version": "1.0.0"
+}
 
 @app.post("/api/chat/send")
 async def send_message(request: Request):
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
         message = body.get("message", "")
         session_id = body.get("session_id", "default")
         
@@ -90,72 +165,101 @@ async def send_message(request: Request):
         
         response_data = {
             "response": ai_response,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.now(),
             "confidence": 0.9,
-            "context": {
-                "message_count": 1,
-                "session_duration": 0,
-                "user_preferences": {"language": "es"}
-            },
-            "model_info": {
-                "model": "fast-demo",
-                "version": "1.0.0"
-            },
+            "context": CHAT_CONTEXT,
+            "model_info": CHAT_MODEL_INFO,
             "session_id": session_id
         }
         
-        return response_data
+        return ORJSONResponse(content=response_data)
         
-    except Exception as e:
-        print(f"Error procesando mensaje: {e}")
+    except Exception:
+        logger.exception("Error procesando mensaje")
         return {"error": "Error interno del servidor"}
 
+# Esquemas fijos de los mensajes WebSocket: msgspec (de)serializa sin pasar por dicts
+class IncomingMessage(msgspec.Struct):
+    type: Optional[str] = None
+    message: str = ""
+    session_id: Optional[str] = "default"
+    is_typing: bool = False
+
+class ChatReply(msgspec.Struct, kw_only=True):
+    type: str = "response"
+    message: str
+    confidence: float
+    timestamp: str
+    session_id: Optional[str]
+    model_info: dict
+
+class TypingReply(msgspec.Struct, kw_only=True):
+    type: str = "typing"
+    is_typing: bool
+    timestamp: str
+
+message_decoder = msgspec.json.Decoder(IncomingMessage)
+message_encoder = msgspec.json.Encoder()
+
+WS_MODEL_INFO = {"model": "fast-websocket-demo"}
+
+async def on_message(websocket: WebSocket, message_data: IncomingMessage):
+    ai_response = ChatReply(
+        message=f"¡Hola! Recibí tu mensaje: '{message_data.message}'. Esta es una respuesta rápida desde WebSocket.",
+        confidence=0.9,
+        timestamp=CURRENT_ISO,
+        session_id=message_data.session_id,
+        model_info=WS_MODEL_INFO
+    )
+    
+    await manager.send_personal_message(message_encoder.encode(ai_response), websocket)
+
+async def on_ping(websocket: WebSocket, message_data: IncomingMessage):
+    await manager.send_personal_message(PONG_PREFIX + CURRENT_ISO.encode() + PONG_SUFFIX, websocket)
+
+async def on_typing(websocket: WebSocket, message_data: IncomingMessage):
+    typing_response = TypingReply(is_typing=message_data.is_typing, timestamp=CURRENT_ISO)
+    await manager.send_personal_message(message_encoder.encode(typing_response), websocket)
+
+# Despacho por tipo de mensaje: una sola búsqueda en dict por frame
+HANDLERS = {
+    "message": on_message,
+    "ping": on_ping,
+    "typing": on_typing,
+}
+
 @app.websocket("/ws/chat")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     try:
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            data = await receive_payload(websocket)
+            message_data = message_decoder.decode(data)
             
-            if message_data.get("type") == "message":
-                user_message = message_data.get("message", "")
-                session_id = message_data.get("session_id", "default")
-                
-                ai_response = {
-                    "type": "response",
-                    "message": f"¡Hola! Recibí tu mensaje: '{user_message}'. Esta es una respuesta rápida desde WebSocket.",
-                    "confidence": 0.9,
-                    "timestamp": datetime.now().isoformat(),
-                    "session_id": session_id,
-                    "model_info": {"model": "fast-websocket-demo"}
-                }
-                
-                await manager.send_personal_message(json.dumps(ai_response), websocket)
-                
-            elif message_data.get("type") == "ping":
-                pong_response = {"type": "pong", "timestamp": datetime.now().isoformat()}
-                await manager.send_personal_message(json.dumps(pong_response), websocket)
-                
-            elif message_data.get("type") == "typing":
-                typing_response = {
-                    "type": "typing",
-                    "is_typing": message_data.get("is_typing", False),
-                    "timestamp": datetime.now().isoformat()
-                }
-                await manager.send_personal_message(json.dumps(typing_response), websocket)
+            handler = HANDLERS.get(message_data.type)
+            if handler is not None:
+                await handler(websocket, message_data)
                 
     except WebSocketDisconnect:
         manager.disconnect(websocket)
-    except Exception as e:
-        print(f"Error en WebSocket: {e}")
+    except Exception:
+        logger.exception("Error en WebSocket")
         manager.disconnect(websocket)
 
 if __name__ == "__main__":
+    reload = os.getenv("RELOAD", "True").lower() == "true"
     uvicorn.run(
         "main_fast:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
-        log_level="info"
+        reload=reload,
+        workers=None if reload else os.cpu_count(),
+        log_level="info",
+        # uvloop no está disponible en Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets",
+        # Los frames de chat son pequeños: comprimirlos cuesta más CPU de lo que ahorra
+        ws_per_message_deflate=False,
+        ws_max_size=65536
     )
\ No newline at end of file
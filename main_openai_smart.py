@@ -1,24 +1,55 @@
 import os
+import sys
 import uvicorn
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, Field
+from typing import Optional
 from dotenv import load_dotenv
-import json
+import orjson
 from datetime import datetime
-import openai
+import httpx
+from openai import AsyncOpenAI
 import asyncio
+import logging
+import random
+import time
+import numpy as np
+import aiosqlite
+
+from src.core.logger import setup_logging, shutdown_logging
+from src.services.response_cache import ExactResponseCache, SemanticResponseCache
 
 load_dotenv("config_temp.env")
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+log = logging.getLogger("lenrodai")
+
+# Cliente asíncrono: las llamadas a OpenAI no bloquean el event loop.
+# Se crea en el arranque sobre un pool HTTP compartido (ver startup_event)
+client: AsyncOpenAI = None
+
+MODEL_NAME = os.getenv("MODEL_NAME", "gpt-4o-mini")
+# Enrutado por coste: los mensajes largos o que piden análisis van al modelo grande
+ESCALATION_MODEL = os.getenv("ESCALATION_MODEL", "gpt-4o")
+ROUTING_MAX_CHARS = 200
+ROUTING_KEYWORDS = ("código", "analiza", "explica detallado")
+MAX_TOKENS = int(os.getenv("MAX_TOKENS", 1000))
+TEMPERATURE = float(os.getenv("TEMPERATURE", 0.7))
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", 500))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", 200000))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+# Mismo prompt en todas las entradas: un prefijo idéntico aprovecha la caché de prompts de OpenAI
+SYSTEM_PROMPT = "Eres un asistente de IA inteligente, sofisticado y profesional. Responde en español de manera útil, precisa y amigable."
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
 
 app = FastAPI(
     title="AI Chat Assistant - Smart Version",
     version="1.0.0",
-    docs_url="/api/docs"
+    docs_url="/api/docs",
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -40,6 +71,7 @@ class TokenMonitor:
         self.last_check = None
         self.consecutive_errors = 0
         self.max_consecutive_errors = 3
+        self.route_stats: dict[str, dict] = {}
         
     def check_openai_availability(self):
         self.last_check = datetime.now()
@@ -52,12 +84,12 @@ class TokenMonitor:
         
         if "quota" in str(error).lower() or "rate limit" in str(error).lower():
             self.openai_available = False
-            print(f"OpenAI no disponible - Error de cuota: {error}")
+            log.warning("OpenAI no disponible - Error de cuota: %s", error)
             return False
         
         if self.consecutive_errors >= self.max_consecutive_errors:
             self.openai_available = False
-            print(f"OpenAI no disponible - Demasiados errores consecutivos: {self.consecutive_errors}")
+            log.warning("OpenAI no disponible - Demasiados errores consecutivos: %d", self.consecutive_errors)
             return False
         
         return True
@@ -66,7 +98,12 @@ class TokenMonitor:
         self.consecutive_errors = 0
         if self.error_count > 0:
             self.openai_available = True
-            print("Errores de OpenAI reseteados - Disponible nuevamente")
+            log.info("Errores de OpenAI reseteados - Disponible nuevamente")
+    
+    def record_route(self, model: str, tokens: int):
+        stats = self.route_stats.setdefault(model, {"requests": 0, "tokens": 0})
+        stats["requests"] += 1
+        stats["tokens"] += tokens
     
     def get_status(self):
         return {
@@ -74,61 +111,165 @@ class TokenMonitor:
             "last_error": self.last_error,
             "error_count": self.error_count,
             "consecutive_errors": self.consecutive_errors,
-            "last_check": self.last_check.isoformat() if self.last_check else None
+            "last_check": self.last_check.isoformat() if self.last_check else None,
+            "routes": self.route_stats
         }
 
 token_monitor = TokenMonitor()
 
+class TokenBucket:
+    """Limitador proactivo de peticiones y tokens por minuto para OpenAI"""
+    
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_tokens = float(requests_per_minute)
+        self.token_tokens = float(tokens_per_minute)
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.request_tokens = min(self.requests_per_minute,
+                                  self.request_tokens + elapsed * self.requests_per_minute / 60)
+        self.token_tokens = min(self.tokens_per_minute,
+                                self.token_tokens + elapsed * self.tokens_per_minute / 60)
+        self.last_update = now
+    
+    async def acquire(self, estimated_tokens: int):
+        # Una petición nunca puede pedir más que la capacidad del cubo
+        estimated_tokens = min(estimated_tokens, self.tokens_per_minute)
+        
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.request_tokens >= 1 and self.token_tokens >= estimated_tokens:
+                    self.request_tokens -= 1
+                    self.token_tokens -= estimated_tokens
+                    return
+                
+                # Esperar localmente lo necesario en vez de recibir un 429
+                request_wait = max(0.0, 1 - self.request_tokens) * 60 / self.requests_per_minute
+                token_wait = max(0.0, estimated_tokens - self.token_tokens) * 60 / self.tokens_per_minute
+                await asyncio.sleep(max(request_wait, token_wait))
+
+rate_limiter = TokenBucket(OPENAI_RPM, OPENAI_TPM)
+
+response_cache = ExactResponseCache()
+
+class PersistentCache:
+    """Copia en SQLite (WAL) de la caché exacta: sobrevive a los reinicios"""
+    
+    def __init__(self, path: str, ttl: float = 3600):
+        self.path = path
+        self.ttl = ttl
+        self.db: aiosqlite.Connection = None
+    
+    async def open(self):
+        self.db = await aiosqlite.connect(self.path)
+        await self.db.execute("PRAGMA journal_mode=WAL")
+        await self.db.execute("PRAGMA synchronous=NORMAL")
+        await self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses("
+            "key TEXT PRIMARY KEY, response TEXT, created_at REAL, tokens INTEGER)"
+        )
+        await self.db.commit()
+    
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+    
+    async def get(self, key: str):
+        if self.db is None:
+            return None
+        
+        async with self.db.execute(
+            "SELECT response, created_at, tokens FROM responses WHERE key = ?", (key,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        
+        # Hora de pared: las entradas se comparan entre ejecuciones distintas
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return {"response": row[0], "usage": {"total_tokens": row[2]}}
+    
+    async def set(self, key: str, value: dict):
+        if self.db is None:
+            return
+        
+        await self.db.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created_at, tokens) VALUES (?, ?, ?, ?)",
+            (key, value["response"], time.time(), value["usage"]["total_tokens"])
+        )
+        await self.db.commit()
+
+persistent_cache = PersistentCache(os.getenv("CACHE_DB_PATH", "cache.db"))
+
+# Umbral adaptativo: /api/feedback lo sube o baja según la calidad de los aciertos
+semantic_cache = SemanticResponseCache(threshold=0.92)
+
+async def embed_message(message: str):
+    try:
+        # Los embeddings también consumen la cuota de OpenAI: pasan por el mismo limitador
+        await rate_limiter.acquire(len(message) // 4 + 1)
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=message)
+        embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return embedding / np.linalg.norm(embedding)
+    except Exception as error:
+        log.warning("Error obteniendo embedding: %s", error)
+        return None
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.active_connections: set[WebSocket] = set()
     
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
-        print(f"Conexión WebSocket establecida. Total: {len(self.active_connections)}")
+        self.active_connections.add(websocket)
+        log.debug("Conexión WebSocket establecida. Total: %d", len(self.active_connections))
     
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        print(f"Conexión WebSocket cerrada. Total: {len(self.active_connections)}")
+        self.active_connections.discard(websocket)
+        log.debug("Conexión WebSocket cerrada. Total: %d", len(self.active_connections))
     
-    async def send_personal_message(self, message: str, websocket: WebSocket):
+    async def send_personal_message(self, message: bytes, websocket: WebSocket):
         try:
-            await websocket.send_text(message)
+            await websocket.send_bytes(message)
         except Exception as e:
-            print(f"Error enviando mensaje personal: {e}")
+            log.debug("Error enviando mensaje personal: %s", e)
             self.disconnect(websocket)
     
-    async def broadcast(self, message: str):
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                print(f"Error en broadcast: {e}")
-                disconnected.append(connection)
-        
-        for connection in disconnected:
-            self.disconnect(connection)
+    async def broadcast(self, message: bytes):
+        # Envíos concurrentes: la latencia total es la del socket más lento, no la suma
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_bytes(message) for connection in connections),
+            return_exceptions=True
+        )
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                log.debug("Error en broadcast: %s", result)
+                self.disconnect(connection)
 
 manager = ConnectionManager()
 
+# Plantillas de respaldo precompiladas: solo se formatea la elegida
+FALLBACK_TEMPLATES = (
+    "Entiendo tu mensaje: '{user_message}'. Actualmente estoy usando respuestas simuladas porque mi API de OpenAI no está disponible. ¡Pero sigo aquí para ayudarte!",
+    "¡Hola! Recibí: '{user_message}'. Estoy funcionando en modo respaldo mientras se resuelve la conexión con OpenAI.",
+    "Perfecto, capté tu mensaje: '{user_message}'. Aunque no tengo acceso a OpenAI en este momento, puedo simular respuestas inteligentes para ti.",
+    "Gracias por tu mensaje: '{user_message}'. Estoy operando con respuestas de respaldo hasta que se restaure el servicio de IA.",
+    "¡Muy bien! Tu mensaje '{user_message}' fue recibido. Funcionando en modo de respaldo con respuestas simuladas."
+)
+
 def create_fallback_response(user_message: str, session_id: str = "default"):
-    fallback_responses = [
-        f"Entiendo tu mensaje: '{user_message}'. Actualmente estoy usando respuestas simuladas porque mi API de OpenAI no está disponible. ¡Pero sigo aquí para ayudarte!",
-        f"¡Hola! Recibí: '{user_message}'. Estoy funcionando en modo respaldo mientras se resuelve la conexión con OpenAI.",
-        f"Perfecto, capté tu mensaje: '{user_message}'. Aunque no tengo acceso a OpenAI en este momento, puedo simular respuestas inteligentes para ti.",
-        f"Gracias por tu mensaje: '{user_message}'. Estoy operando con respuestas de respaldo hasta que se restaure el servicio de IA.",
-        f"¡Muy bien! Tu mensaje '{user_message}' fue recibido. Funcionando en modo de respaldo con respuestas simuladas."
-    ]
-    
-    import random
-    response_text = random.choice(fallback_responses)
+    response_text = FALLBACK_TEMPLATES[random.randrange(len(FALLBACK_TEMPLATES))].format(user_message=user_message)
     
     return {
         "response": response_text,
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": CURRENT_ISO,
         "confidence": 0.7,
         "context": {
             "fallback_mode": True,
@@ -146,50 +287,160 @@ def create_fallback_response(user_message: str, session_id: str = "default"):
         "warning": "Los tokens de OpenAI se han agotado o hay un problema de conexión. Usando respuestas simuladas."
     }
 
-async def call_openai_api(message: str, session_id: str = "default"):
+def select_model(message: str) -> str:
+    """Elige el modelo más barato que basta para el mensaje"""
+    lowered = message.lower()
+    if len(message) < ROUTING_MAX_CHARS and not any(keyword in lowered for keyword in ROUTING_KEYWORDS):
+        return MODEL_NAME
+    return ESCALATION_MODEL
+
+def build_openai_response(ai_response: str, session_id: str, usage: dict, model: str = MODEL_NAME,
+                          cache_hit: bool = False, semantic_hit: bool = False):
+    return {
+        "response": ai_response,
+        "timestamp": CURRENT_ISO,
+        "confidence": 0.9,
+        "context": {
+            "openai_available": True,
+            "cache_hit": cache_hit,
+            "semantic_hit": semantic_hit,
+            "message_count": 1,
+            "session_duration": 0,
+            "user_preferences": {"language": "es"}
+        },
+        "model_info": {
+            "model": model,
+            "version": "1.0.0",
+            "usage": usage
+        },
+        "session_id": session_id
+    }
+
+# Llamadas a OpenAI en curso por clave de caché: los prompts idénticos concurrentes comparten una sola
+INFLIGHT: dict[str, asyncio.Task] = {}
+
+async def fetch_completion(message: str, cache_key: str, model: str):
+    """Obtiene la respuesta desde la caché semántica o desde OpenAI"""
     try:
         if not token_monitor.check_openai_availability():
             return None
         
-        response = openai.ChatCompletion.create(
-            model=os.getenv("MODEL_NAME", "gpt-3.5-turbo"),
+        embedding = await embed_message(message)
+        if embedding is not None:
+            # Solo respuestas del mismo modelo enrutado: un mensaje escalado no recibe una del modelo pequeño
+            similar = semantic_cache.lookup(embedding, model=model)
+            if similar is not None:
+                return {"response": similar["response"], "usage": similar["usage"],
+                        "model": model, "semantic_hit": True}
+        
+        await rate_limiter.acquire(MAX_TOKENS + len(message) // 4)
+        
+        response = await client.chat.completions.create(
+            model=model,
             messages=[
-                {"role": "system", "content": "Eres un asistente de IA útil y amigable. Responde en español de manera clara y concisa."},
+                SYSTEM_MSG,
                 {"role": "user", "content": message}
             ],
-            max_tokens=int(os.getenv("MAX_TOKENS", 1000)),
-            temperature=float(os.getenv("TEMPERATURE", 0.7))
+            max_tokens=MAX_TOKENS,
+            temperature=TEMPERATURE
         )
         
         token_monitor.reset_errors()
+        token_monitor.record_route(model, response.usage.total_tokens)
         
         ai_response = response.choices[0].message.content
-        
-        return {
-            "response": ai_response,
-            "timestamp": datetime.now().isoformat(),
-            "confidence": 0.9,
-            "context": {
-                "openai_available": True,
-                "message_count": 1,
-                "session_duration": 0,
-                "user_preferences": {"language": "es"}
-            },
-            "model_info": {
-                "model": os.getenv("MODEL_NAME", "gpt-3.5-turbo"),
-                "version": "1.0.0",
-                "usage": response.usage
-            },
-            "session_id": session_id
-        }
+        usage = {"total_tokens": response.usage.total_tokens}
         
     except Exception as error:
-        print(f"Error llamando a OpenAI: {error}")
+        log.warning("Error llamando a OpenAI: %s", error)
         
         if not token_monitor.handle_openai_error(error):
             return None
         
         raise error
+    
+    # Fuera del try de OpenAI: un fallo de la caché local no cuenta como error de OpenAI ni descarta la respuesta
+    response_cache.set(cache_key, {"response": ai_response, "usage": usage})
+    try:
+        await persistent_cache.set(cache_key, {"response": ai_response, "usage": usage})
+    except Exception:
+        log.exception("Error guardando en la caché persistente")
+    if embedding is not None:
+        semantic_cache.add(embedding, {"response": ai_response, "usage": usage, "model": model})
+    
+    return {"response": ai_response, "usage": usage, "model": model, "semantic_hit": False}
+
+async def call_openai_api(message: str, session_id: str = "default"):
+    model = select_model(message)
+    cache_key = ExactResponseCache.make_key(model, SYSTEM_PROMPT, message, MAX_TOKENS, TEMPERATURE)
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        cached = await persistent_cache.get(cache_key)
+        if cached is not None:
+            response_cache.set(cache_key, cached)
+    if cached is not None:
+        return build_openai_response(cached["response"], session_id, cached["usage"], model, cache_hit=True)
+    
+    task = INFLIGHT.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(fetch_completion(message, cache_key, model))
+        INFLIGHT[cache_key] = task
+        task.add_done_callback(lambda _: INFLIGHT.pop(cache_key, None))
+    
+    # shield: si un cliente se desconecta no se cancela la llamada compartida con los demás
+    result = await asyncio.shield(task)
+    if result is None:
+        return None
+    
+    return build_openai_response(result["response"], session_id, result["usage"], result["model"],
+                                 cache_hit=result["semantic_hit"], semantic_hit=result["semantic_hit"])
+
+async def chat_turn(user_message: str, session_id: str = "default"):
+    """Turno de chat común a HTTP y WebSocket: OpenAI con caché y límites, o respaldo"""
+    try:
+        response_data = await call_openai_api(user_message, session_id)
+        if response_data:
+            return response_data
+        log.warning("OpenAI no disponible, usando respuesta de respaldo")
+    except Exception:
+        log.exception("Error en API de OpenAI")
+    return create_fallback_response(user_message, session_id)
+
+# Timestamp ISO compartido, refrescado en segundo plano para no formatearlo en cada mensaje
+TIMESTAMP_REFRESH_INTERVAL = 0.1
+CURRENT_ISO = datetime.now().isoformat()
+
+async def refresh_timestamp():
+    global CURRENT_ISO
+    while True:
+        CURRENT_ISO = datetime.now().isoformat()
+        await asyncio.sleep(TIMESTAMP_REFRESH_INTERVAL)
+
+@app.on_event("startup")
+async def startup_event():
+    global client
+    setup_logging()
+    app.state.timestamp_task = asyncio.create_task(refresh_timestamp())
+    await persistent_cache.open()
+    # Conexiones keep-alive reutilizadas: sin handshake TLS por mensaje y con multiplexado HTTP/2
+    app.state.http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+        timeout=30.0
+    )
+    client = AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY", ""),
+        http_client=app.state.http_client,
+        timeout=30.0,
+        max_retries=0
+    )
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.timestamp_task.cancel()
+    await persistent_cache.close()
+    await app.state.http_client.aclose()
+    shutdown_logging()
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
@@ -199,7 +450,7 @@ async def read_root(request: Request):
 async def health_check():
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": CURRENT_ISO,
         "active_connections": len(manager.active_connections),
         "openai_status": token_monitor.get_status()
     }
@@ -209,110 +460,95 @@ async def get_token_status():
     return {
         "status": token_monitor.get_status(),
         "message": "OpenAI no disponible - Tokens agotados" if not token_monitor.openai_available else "OpenAI disponible",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": CURRENT_ISO
+    }
+
+class FeedbackIn(BaseModel):
+    helpful: bool = True
+    semantic_hit: bool = False
+
+@app.post("/api/feedback")
+async def submit_feedback(body: FeedbackIn):
+    # Solo los aciertos semánticos ajustan el umbral de similitud
+    if body.semantic_hit:
+        semantic_cache.record_feedback(body.helpful)
+    
+    return {
+        "message": "Feedback recibido correctamente",
+        "semantic_cache": semantic_cache.get_status(),
+        "timestamp": CURRENT_ISO
     }
 
+# Validación en la capa de FastAPI: los mensajes vacíos o demasiado largos se rechazan antes del handler
+class ChatIn(BaseModel):
+    message: str = Field(..., min_length=1, max_length=2000)
+    session_id: Optional[str] = "default"
+
 @app.post("/api/chat/send")
-async def send_message(request: Request):
+async def send_message(body: ChatIn):
     try:
-        body = await request.json()
-        message = body.get("message", "")
-        session_id = body.get("session_id", "default")
+        message = body.message
+        session_id = body.session_id
         
         if not message.strip():
             return {"error": "El mensaje no puede estar vacío"}
         
-        if len(message) > 2000:
-            return {"error": "El mensaje es demasiado largo"}
-        
-        try:
-            response_data = await call_openai_api(message, session_id)
-            
-            if response_data:
-                return response_data
-            else:
-                print("OpenAI no disponible, usando respuesta de respaldo")
-                return create_fallback_response(message, session_id)
-                
-        except Exception as error:
-            print(f"Error en API de OpenAI: {error}")
-            return create_fallback_response(message, session_id)
+        return await chat_turn(message, session_id)
         
-    except Exception as e:
-        print(f"Error procesando mensaje: {e}")
+    except Exception:
+        log.exception("Error procesando mensaje")
         return {"error": "Error interno del servidor"}
 
+# Plantillas de los mensajes de control: solo se inserta el timestamp
+PONG_PREFIX = b'{"type":"pong","timestamp":"'
+PONG_SUFFIX = b'"}'
+TYPING_ON_PREFIX = b'{"type":"typing","is_typing":true,"timestamp":"'
+TYPING_OFF_PREFIX = b'{"type":"typing","is_typing":false,"timestamp":"'
+
 @app.websocket("/ws/chat")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
+    # Referencias locales: evitan resolver atributos en cada iteración del bucle
+    receive = websocket.receive_text
+    send = manager.send_personal_message
+    loads = orjson.loads
+    dumps = orjson.dumps
     try:
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            data = await receive()
+            message_data = loads(data)
+            message_type = message_data.get("type")
             
-            if message_data.get("type") == "message":
+            if message_type == "message":
                 user_message = message_data.get("message", "")
                 session_id = message_data.get("session_id", "default")
                 
-                try:
-                    response_data = await call_openai_api(user_message, session_id)
-                    
-                    if response_data:
-                        ai_response = {
-                            "type": "response",
-                            "message": response_data["response"],
-                            "confidence": response_data["confidence"],
-                            "timestamp": response_data["timestamp"],
-                            "session_id": session_id,
-                            "model_info": response_data["model_info"],
-                            "context": response_data["context"]
-                        }
-                    else:
-                        fallback_data = create_fallback_response(user_message, session_id)
-                        ai_response = {
-                            "type": "response",
-                            "message": fallback_data["response"],
-                            "confidence": fallback_data["confidence"],
-                            "timestamp": fallback_data["timestamp"],
-                            "session_id": session_id,
-                            "model_info": fallback_data["model_info"],
-                            "context": fallback_data["context"],
-                            "warning": fallback_data["warning"]
-                        }
-                    
-                    await manager.send_personal_message(json.dumps(ai_response), websocket)
-                    
-                except Exception as error:
-                    print(f"Error en WebSocket OpenAI: {error}")
-                    fallback_data = create_fallback_response(user_message, session_id)
-                    ai_response = {
-                        "type": "response",
-                        "message": fallback_data["response"],
-                        "confidence": fallback_data["confidence"],
-                        "timestamp": fallback_data["timestamp"],
-                        "session_id": session_id,
-                        "model_info": fallback_data["model_info"],
-                        "context": fallback_data["context"],
-                        "warning": fallback_data["warning"]
-                    }
-                    await manager.send_personal_message(json.dumps(ai_response), websocket)
+                response_data = await chat_turn(user_message, session_id)
+                ai_response = {
+                    "type": "response",
+                    "message": response_data["response"],
+                    "confidence": response_data["confidence"],
+                    "timestamp": response_data["timestamp"],
+                    "session_id": session_id,
+                    "model_info": response_data["model_info"],
+                    "context": response_data["context"]
+                }
+                if "warning" in response_data:
+                    ai_response["warning"] = response_data["warning"]
                 
-            elif message_data.get("type") == "ping":
-                pong_response = {"type": "pong", "timestamp": datetime.now().isoformat()}
-                await manager.send_personal_message(json.dumps(pong_response), websocket)
+                await send(dumps(ai_response), websocket)
                 
-            elif message_data.get("type") == "typing":
-                typing_response = {
-                    "type": "typing",
-                    "is_typing": message_data.get("is_typing", False),
-                    "timestamp": datetime.now().isoformat()
-                }
-                await manager.send_personal_message(json.dumps(typing_response), websocket)
+            elif message_type == "ping":
+                await send(PONG_PREFIX + CURRENT_ISO.encode() + PONG_SUFFIX, websocket)
+                
+            elif message_type == "typing":
+                prefix = TYPING_ON_PREFIX if message_data.get("is_typing", False) else TYPING_OFF_PREFIX
+                await send(prefix + CURRENT_ISO.encode() + PONG_SUFFIX, websocket)
                 
     except WebSocketDisconnect:
         manager.disconnect(websocket)
-    except Exception as e:
-        print(f"Error en WebSocket: {e}")
+    except Exception:
+        log.exception("Error en WebSocket")
         manager.disconnect(websocket)
 
 if __name__ == "__main__":
@@ -320,6 +556,13 @@ if __name__ == "__main__":
         "main_openai_smart:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
+        reload=False,
+        # Cachés y limitador viven en cada proceso: OPENAI_RPM/OPENAI_TPM se aplican por worker
+        workers=int(os.getenv("WORKERS", min(4, os.cpu_count() or 1))),
+        log_level="warning",
+        access_log=False,
+        # uvloop no está disponible en Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets"
+    )
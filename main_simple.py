@@ -4,28 +4,36 @@ Asistente de chat inteligente básico
 """
 
 import os
+import sys
 import uvicorn
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-import json
+import orjson
 import asyncio
-from typing import List, Dict, Any
+import logging
+from typing import Dict, Any
 from datetime import datetime
 
+from src.core.logger import setup_logging, shutdown_logging
+from src.core.ws_frames import receive_payload
+
 # Cargar variables de entorno
 load_dotenv()
 
+log = logging.getLogger("lenrodai")
+
 # Crear aplicación FastAPI
 app = FastAPI(
     title="AI Chat Assistant",
     description="Asistente de chat inteligente con procesamiento de lenguaje natural",
     version="1.0.0",
     docs_url="/api/docs",
-    redoc_url="/api/redoc"
+    redoc_url="/api/redoc",
+    default_response_class=ORJSONResponse
 )
 
 # Configurar CORS
@@ -42,26 +50,47 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Configurar templates
 templates = Jinja2Templates(directory="templates")
+DEBUG = os.getenv("DEBUG", "True").lower() == "true"
 
 # Conexiones WebSocket activas
-active_connections: List[WebSocket] = []
+active_connections: set[WebSocket] = set()
+
+# Timestamp ISO compartido, refrescado en segundo plano para no formatearlo en cada mensaje
+TIMESTAMP_REFRESH_INTERVAL = 0.05
+CURRENT_ISO = datetime.now().isoformat(timespec="milliseconds")
+
+async def refresh_timestamp():
+    global CURRENT_ISO
+    while True:
+        CURRENT_ISO = datetime.now().isoformat(timespec="milliseconds")
+        await asyncio.sleep(TIMESTAMP_REFRESH_INTERVAL)
 
 @app.on_event("startup")
 async def startup_event():
     """Inicializar la aplicación"""
-    print("Iniciando AI Chat Assistant...")
-    print("Aplicacion iniciada correctamente")
+    setup_logging()
+    log.info("Iniciando AI Chat Assistant...")
+    app.state.timestamp_task = asyncio.create_task(refresh_timestamp())
+    # La plantilla no usa variables por petición: se lee una sola vez
+    with open("templates/index.html", "rb") as f:
+        app.state.index_html = f.read()
+    log.info("Aplicacion iniciada correctamente")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cerrar la aplicación"""
-    print("Cerrando AI Chat Assistant...")
-    print("Aplicacion cerrada correctamente")
+    log.info("Cerrando AI Chat Assistant...")
+    app.state.timestamp_task.cancel()
+    log.info("Aplicacion cerrada correctamente")
+    shutdown_logging()
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     """Página principal"""
-    return templates.TemplateResponse("index.html", {"request": request})
+    # En desarrollo se renderiza en cada petición para ver los cambios de la plantilla
+    if DEBUG:
+        return templates.TemplateResponse("index.html", {"request": request})
+    return HTMLResponse(content=app.state.index_html)
 
 @app.get("/health")
 async def health_check():
@@ -84,7 +113,7 @@ async def send_message(request: Request):
         ai_response = {
             "message": f"¡Hola! Recibí tu mensaje: '{user_message}'. Esta es una respuesta de prueba. Para usar OpenAI, configura tu API key.",
             "confidence": 0.8,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": CURRENT_ISO,
             "model": "demo",
             "usage": {"total_tokens": 50}
         }
@@ -111,26 +140,24 @@ async def send_message(request: Request):
 async def websocket_endpoint(websocket: WebSocket):
     """Endpoint WebSocket para chat en tiempo real"""
     await websocket.accept()
-    active_connections.append(websocket)
+    active_connections.add(websocket)
     
     try:
         while True:
-            # Recibir mensaje del cliente
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            message_data = orjson.loads(await receive_payload(websocket))
             
             # Procesar mensaje
             response = await process_chat_message(message_data)
             
             # Enviar respuesta
-            await websocket.send_text(json.dumps(response))
+            await websocket.send_bytes(orjson.dumps(response))
             
     except WebSocketDisconnect:
-        active_connections.remove(websocket)
-    except Exception as e:
-        print(f"Error en WebSocket: {e}")
-        if websocket in active_connections:
-            active_connections.remove(websocket)
+        pass
+    except Exception:
+        log.exception("Error en WebSocket")
+    finally:
+        active_connections.discard(websocket)
 
 async def process_chat_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
     """Procesar mensaje de chat"""
@@ -142,7 +169,7 @@ async def process_chat_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
         ai_response = {
             "message": f"¡Hola! Recibí tu mensaje: '{user_message}'. Esta es una respuesta de prueba via WebSocket.",
             "confidence": 0.8,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": CURRENT_ISO
         }
         
         return {
@@ -157,14 +184,23 @@ async def process_chat_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
         return {
             "type": "error",
             "message": f"Error procesando mensaje: {str(e)}",
-            "timestamp": datetime.now().isoformat()
+            "timestamp": CURRENT_ISO
         }
 
 if __name__ == "__main__":
     uvicorn.run(
         "main_simple:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        # El vigilante de recarga solo en desarrollo
+        reload=DEBUG,
+        workers=int(os.getenv("WORKERS", min(4, os.cpu_count() or 1))),
+        log_level="info" if DEBUG else "warning",
+        access_log=False,
+        # uvloop no está disponible en Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets",
+        # Los frames de chat son pequeños: comprimir solo compensa con difusiones grandes
+        ws_per_message_deflate=os.getenv("WS_COMPRESS", "False").lower() == "true"
     )
@@ -1,21 +1,33 @@
 import os
+import sys
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, WebSocket
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, Field
+from typing import Optional
 from dotenv import load_dotenv
-import json
+import orjson
 from datetime import datetime
-import openai
+import asyncio
+import logging
+import httpx
+from openai import AsyncOpenAI
+
+from src.core.logger import setup_logging, shutdown_logging
+from src.services.response_cache import ExactResponseCache
 
 load_dotenv("config_temp.env")
 
+log = logging.getLogger("lenrodai")
+
 app = FastAPI(
     title="AI Chat Assistant",
     version="1.0.0",
-    docs_url="/api/docs"
+    docs_url="/api/docs",
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -30,7 +42,56 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 templates = Jinja2Templates(directory="templates")
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_CONFIGURED = bool(OPENAI_API_KEY and OPENAI_API_KEY != "your_openai_api_key_here")
+
+# Cliente asíncrono: las llamadas a OpenAI no bloquean el event loop.
+# Se crea en el arranque sobre un pool HTTP compartido (ver startup_event)
+client: AsyncOpenAI = None
+
+MODEL_NAME = os.getenv("MODEL_NAME", "gpt-4o-mini")
+MAX_TOKENS = 1000
+TEMPERATURE = 0.7
+# Mismo prompt en todas las entradas: un prefijo idéntico aprovecha la caché de prompts de OpenAI
+SYSTEM_PROMPT = "Eres un asistente de IA inteligente, sofisticado y profesional. Responde en español de manera útil, precisa y amigable."
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+response_cache = ExactResponseCache()
+
+# Timestamp ISO compartido, refrescado en segundo plano para no formatearlo en cada mensaje
+TIMESTAMP_REFRESH_INTERVAL = 0.1
+CURRENT_ISO = datetime.now().isoformat()
+
+async def refresh_timestamp():
+    global CURRENT_ISO
+    while True:
+        CURRENT_ISO = datetime.now().isoformat()
+        await asyncio.sleep(TIMESTAMP_REFRESH_INTERVAL)
+
+@app.on_event("startup")
+async def startup_event():
+    global client
+    setup_logging()
+    app.state.timestamp_task = asyncio.create_task(refresh_timestamp())
+    # Conexiones keep-alive reutilizadas: sin handshake TLS por mensaje y con multiplexado HTTP/2
+    app.state.http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+        timeout=30.0
+    )
+    if OPENAI_CONFIGURED:
+        client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            http_client=app.state.http_client,
+            timeout=30.0,
+            max_retries=0
+        )
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.timestamp_task.cancel()
+    await app.state.http_client.aclose()
+    shutdown_logging()
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
@@ -42,47 +103,68 @@ async def health_check():
         "status": "healthy",
         "message": "AI Chat Assistant is running",
         "version": "1.0.0",
-        "openai_configured": bool(openai.api_key and openai.api_key != "your_openai_api_key_here")
+        "openai_configured": OPENAI_CONFIGURED
     }
 
+# Validación en la capa de FastAPI: los mensajes vacíos o demasiado largos se rechazan antes del handler
+class ChatIn(BaseModel):
+    message: str = Field(..., min_length=1, max_length=2000)
+    session_id: Optional[str] = "default"
+
 @app.post("/api/chat/send")
-async def send_message(request: Request):
+async def send_message(body: ChatIn):
     try:
-        data = await request.json()
-        user_message = data.get("message", "")
+        user_message = body.message
         
-        if not openai.api_key or openai.api_key == "your_openai_api_key_here":
+        if not OPENAI_CONFIGURED:
             return {
                 "response": "OpenAI no está configurado. Por favor, configura tu API key en config_temp.env",
                 "session_id": "demo-session",
                 "confidence": 0.0,
                 "context": {"demo": True, "openai_configured": False},
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": CURRENT_ISO,
                 "model_info": {"model": "demo"}
             }
         
+        cache_key = ExactResponseCache.make_key(MODEL_NAME, SYSTEM_PROMPT, user_message, MAX_TOKENS, TEMPERATURE)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return {
+                "response": cached["response"],
+                "session_id": "openai-session",
+                "confidence": 0.9,
+                "context": {"openai": True, "model": MODEL_NAME, "cache_hit": True},
+                "timestamp": CURRENT_ISO,
+                "model_info": {
+                    "model": MODEL_NAME,
+                    "usage": cached["usage"]
+                }
+            }
+        
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
+            response = await client.chat.completions.create(
+                model=MODEL_NAME,
                 messages=[
-                    {"role": "system", "content": "Eres un asistente de IA inteligente, sofisticado y profesional. Responde en español de manera útil, precisa y amigable."},
+                    SYSTEM_MSG,
                     {"role": "user", "content": user_message}
                 ],
-                max_tokens=1000,
-                temperature=0.7
+                max_tokens=MAX_TOKENS,
+                temperature=TEMPERATURE
             )
             
             ai_message = response.choices[0].message.content
+            usage = response.usage.model_dump()
+            response_cache.set(cache_key, {"response": ai_message, "usage": usage})
             
             return {
                 "response": ai_message,
                 "session_id": "openai-session",
                 "confidence": 0.9,
-                "context": {"openai": True, "model": "gpt-3.5-turbo"},
-                "timestamp": datetime.now().isoformat(),
+                "context": {"openai": True, "model": MODEL_NAME, "cache_hit": False},
+                "timestamp": CURRENT_ISO,
                 "model_info": {
-                    "model": "gpt-3.5-turbo",
-                    "usage": response.usage.__dict__
+                    "model": MODEL_NAME,
+                    "usage": usage
                 }
             }
             
@@ -92,7 +174,7 @@ async def send_message(request: Request):
                 "session_id": "error-session",
                 "confidence": 0.0,
                 "context": {"error": True},
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": CURRENT_ISO,
                 "model_info": {"model": "error"}
             }
         
@@ -102,16 +184,102 @@ async def send_message(request: Request):
             "message": "Lo siento, hubo un error procesando tu mensaje."
         }
 
+async def stream_chat_reply(websocket: WebSocket, user_message: str):
+    """Reenviar la respuesta de OpenAI por el WebSocket a medida que se genera"""
+    if not OPENAI_CONFIGURED:
+        await websocket.send_bytes(orjson.dumps({
+            "type": "error",
+            "message": "OpenAI no está configurado. Por favor, configura tu API key en config_temp.env",
+            "timestamp": CURRENT_ISO
+        }))
+        return
+    
+    cache_key = ExactResponseCache.make_key(MODEL_NAME, SYSTEM_PROMPT, user_message, MAX_TOKENS, TEMPERATURE)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        await websocket.send_bytes(orjson.dumps({"type": "delta", "content": cached["response"]}))
+        await websocket.send_bytes(orjson.dumps({
+            "type": "done",
+            "context": {"openai": True, "model": MODEL_NAME, "cache_hit": True},
+            "timestamp": CURRENT_ISO,
+            "model_info": {"model": MODEL_NAME, "usage": cached["usage"]}
+        }))
+        return
+    
+    try:
+        stream = await client.chat.completions.create(
+            model=MODEL_NAME,
+            messages=[
+                SYSTEM_MSG,
+                {"role": "user", "content": user_message}
+            ],
+            max_tokens=MAX_TOKENS,
+            temperature=TEMPERATURE,
+            stream=True
+        )
+        
+        parts = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                parts.append(content)
+                await websocket.send_bytes(orjson.dumps({"type": "delta", "content": content}))
+        
+        # El streaming no informa del consumo de tokens en esta versión del SDK
+        usage = {}
+        response_cache.set(cache_key, {"response": "".join(parts), "usage": usage})
+        
+        await websocket.send_bytes(orjson.dumps({
+            "type": "done",
+            "context": {"openai": True, "model": MODEL_NAME, "cache_hit": False},
+            "timestamp": CURRENT_ISO,
+            "model_info": {"model": MODEL_NAME, "usage": usage}
+        }))
+        
+    except Exception as openai_error:
+        await websocket.send_bytes(orjson.dumps({
+            "type": "error",
+            "message": f"Error con OpenAI: {str(openai_error)}. Verifica tu API key.",
+            "timestamp": CURRENT_ISO
+        }))
+
+# Plantilla del pong: solo se inserta el timestamp
+PONG_PREFIX = b'{"type":"pong","timestamp":"'
+PONG_SUFFIX = b'"}'
+
+@app.websocket("/ws/chat")
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        async for data in websocket.iter_text():
+            message_data = orjson.loads(data)
+            message_type = message_data.get("type")
+            
+            if message_type == "message":
+                await stream_chat_reply(websocket, message_data.get("message", ""))
+            elif message_type == "ping":
+                await websocket.send_bytes(PONG_PREFIX + CURRENT_ISO.encode() + PONG_SUFFIX)
+                
+    except Exception:
+        log.exception("Error en WebSocket")
+
 if __name__ == "__main__":
     print("Iniciando AI Chat Assistant con OpenAI...")
     print("Abriendo en: http://localhost:8001")
-    print("OpenAI configurado:", bool(openai.api_key and openai.api_key != "your_openai_api_key_here"))
+    print("OpenAI configurado:", OPENAI_CONFIGURED)
     
     uvicorn.run(
         "main_with_openai:app",
         host="127.0.0.1",
         port=8001,
         reload=False,
+        workers=int(os.getenv("WORKERS", min(4, os.cpu_count() or 1))),
         log_level="warning",
-        access_log=False
+        access_log=False,
+        # uvloop no está disponible en Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets"
     )
\ No newline at end of file
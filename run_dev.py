@@ -4,11 +4,9 @@ Script de inicio para AI Chat Assistant
 Equivalente a 'npm run dev'
 """
 
-import os
 import sys
-import subprocess
+import threading
 import webbrowser
-import time
 from pathlib import Path
 
 def main():
@@ -27,10 +25,14 @@ def main():
     try:
         import fastapi
         import uvicorn
+        # Parser HTTP en C; uvloop no existe en Windows
+        import httptools
+        if sys.platform != "win32":
+            import uvloop
         print("✅ Dependencias verificadas")
     except ImportError as e:
         print(f"❌ Error: {e}")
-        print("   Ejecuta: python -m pip install fastapi uvicorn python-dotenv jinja2 aiofiles websockets")
+        print("   Ejecuta: python -m pip install fastapi uvicorn[standard] python-dotenv jinja2 aiofiles websockets")
         sys.exit(1)
     
     print("📱 Abriendo navegador en 3 segundos...")
@@ -40,7 +42,6 @@ def main():
     
     # Abrir navegador después de 3 segundos
     def open_browser():
-        time.sleep(3)
         try:
             webbrowser.open("http://localhost:8000")
             print("✅ Navegador abierto")
@@ -48,17 +49,28 @@ def main():
             print(f"⚠️ No se pudo abrir el navegador: {e}")
     
     # Iniciar navegador en segundo plano
-    import threading
-    browser_thread = threading.Thread(target=open_browser)
-    browser_thread.daemon = True
-    browser_thread.start()
+    browser_timer = threading.Timer(3, open_browser)
+    browser_timer.daemon = True
+    browser_timer.start()
     
     try:
-        # Ejecutar la aplicación
-        subprocess.run([
-            "C:\\Users\\Usuario\\AppData\\Local\\Microsoft\\WindowsApps\\PythonSoftwareFoundation.Python.3.11_qbz5n2kfra8p0\\python.exe",
-            "main_simple.py"
-        ])
+        # Ejecutar la aplicación en este mismo proceso: sin arrancar otro intérprete
+        import main_simple
+        # Tras importar main_simple, que carga el .env
+        from src.core.config import get_settings
+        uvicorn.run(
+            main_simple.app,
+            host="0.0.0.0",
+            port=8000,
+            log_level="info",
+            access_log=False,
+            # uvloop no está disponible en Windows
+            loop="asyncio" if sys.platform == "win32" else "uvloop",
+            http="httptools",
+            ws="websockets",
+            # Igual que main.py: permessage-deflate solo si WS_COMPRESS está activo
+            ws_per_message_deflate=get_settings().WS_COMPRESS
+        )
     except KeyboardInterrupt:
         print("\n🛑 Aplicación detenida por el usuario")
     except Exception as e:
@@ -3,29 +3,42 @@ API endpoints para chat
 """
 
 from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import List, Dict, Any, Optional
 from datetime import datetime
+import asyncio
+import heapq
 import uuid
+from collections import defaultdict
+from operator import itemgetter
 
-from src.services.ai_service import AIService
-from src.services.ml_service import MLService
+from src.services.ai_service import AIService, get_ai_service
+from src.services.ml_service import MLService, get_ml_service
+from src.services.response_cache import ExactResponseCache
+from src.core.config import get_settings
 from src.core.database import db_manager
+from src.core.db_writer import enqueue_conversation, load_history
+
+settings = get_settings()
 
 # Crear router
 chat_router = APIRouter()
 
-# Instancias de servicios
-ai_service = AIService()
-ml_service = MLService()
+# Respuestas ya generadas para el mismo historial y mensaje (reintentos, reenvíos del cliente);
+# solo con CACHE_CHAT_RESPONSES: con TEMPERATURE > 0 se repetiría la misma respuesta
+response_cache = ExactResponseCache(maxsize=10_000, ttl=3600)
 
 # Modelos Pydantic
 class ChatMessage(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     message: str
     session_id: Optional[str] = None
     context: Optional[Dict[str, Any]] = None
 
 class ChatResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     response: str
     session_id: str
     confidence: float
@@ -34,24 +47,49 @@ class ChatResponse(BaseModel):
     model_info: Dict[str, Any]
 
 class ConversationHistory(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     session_id: str
     limit: Optional[int] = 10
 
 class UserContext(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     session_id: str
     preferences: Optional[Dict[str, Any]] = None
     topics: Optional[List[str]] = None
     personality: Optional[Dict[str, Any]] = None
 
 @chat_router.post("/send", response_model=ChatResponse)
-async def send_message(message_data: ChatMessage):
+async def send_message(message_data: ChatMessage,
+                       ai_service: AIService = Depends(get_ai_service),
+                       ml_service: MLService = Depends(get_ml_service)):
     """Enviar mensaje al chatbot"""
     try:
         # Generar session_id si no se proporciona
         session_id = message_data.session_id or str(uuid.uuid4())
         
         # Obtener historial de conversación
-        conversation_history = db_manager.get_conversation_history(session_id, limit=10)
+        conversation_history = await load_history(session_id, 10)
+        
+        cache_key = None
+        if settings.CACHE_CHAT_RESPONSES:
+            history_tail = [(msg.get("user_message"), msg.get("ai_response")) for msg in conversation_history]
+            cache_key = ExactResponseCache.make_key(
+                history_tail, message_data.message,
+                settings.MODEL_NAME, settings.TEMPERATURE, settings.MAX_TOKENS
+            )
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                # El turno se guarda igualmente para que forme parte del historial
+                await enqueue_conversation(
+                    session_id=session_id,
+                    user_message=message_data.message,
+                    ai_response=cached["response"],
+                    context=cached["context"],
+                    confidence=cached["confidence"]
+                )
+                return ChatResponse(session_id=session_id, **{**cached, "timestamp": datetime.now().isoformat()})
         
         # Analizar contexto con ML
         context = await ml_service.analyze_context(
@@ -67,7 +105,7 @@ async def send_message(message_data: ChatMessage):
         )
         
         # Guardar conversación
-        db_manager.save_conversation(
+        await enqueue_conversation(
             session_id=session_id,
             user_message=message_data.message,
             ai_response=ai_response["message"],
@@ -75,17 +113,21 @@ async def send_message(message_data: ChatMessage):
             confidence=ai_response.get("confidence", 0.8)
         )
         
-        return ChatResponse(
-            response=ai_response["message"],
-            session_id=session_id,
-            confidence=ai_response.get("confidence", 0.8),
-            context=context,
-            timestamp=ai_response.get("timestamp", datetime.now().isoformat()),
-            model_info={
+        response = {
+            "response": ai_response["message"],
+            "confidence": ai_response.get("confidence", 0.8),
+            "context": context,
+            "timestamp": ai_response.get("timestamp", datetime.now().isoformat()),
+            "model_info": {
                 "model": ai_response.get("model", "unknown"),
                 "usage": ai_response.get("usage", {})
             }
-        )
+        }
+        # Los errores de OpenAI no se cachean: un reintento debe volver a intentarlo
+        if cache_key is not None and "error" not in ai_response:
+            response_cache.set(cache_key, response)
+        
+        return ChatResponse(session_id=session_id, **response)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error procesando mensaje: {str(e)}")
@@ -94,7 +136,7 @@ async def send_message(message_data: ChatMessage):
 async def get_conversation_history(session_id: str, limit: int = 10):
     """Obtener historial de conversación"""
     try:
-        history = db_manager.get_conversation_history(session_id, limit)
+        history = await load_history(session_id, limit)
         return {
             "session_id": session_id,
             "history": history,
@@ -107,7 +149,8 @@ async def get_conversation_history(session_id: str, limit: int = 10):
 async def update_user_context(context_data: UserContext):
     """Actualizar contexto del usuario"""
     try:
-        db_manager.update_user_context(
+        await asyncio.to_thread(
+            db_manager.update_user_context,
             session_id=context_data.session_id,
             preferences=context_data.preferences,
             topics=context_data.topics,
@@ -125,7 +168,7 @@ async def update_user_context(context_data: UserContext):
 async def get_user_context(session_id: str):
     """Obtener contexto del usuario"""
     try:
-        context = db_manager.get_user_context(session_id)
+        context = await asyncio.to_thread(db_manager.get_user_context, session_id)
         return {
             "session_id": session_id,
             "context": context
@@ -134,17 +177,17 @@ async def get_user_context(session_id: str):
         raise HTTPException(status_code=500, detail=f"Error obteniendo contexto: {str(e)}")
 
 @chat_router.post("/analyze")
-async def analyze_message(message_data: ChatMessage):
+async def analyze_message(message_data: ChatMessage,
+                          ai_service: AIService = Depends(get_ai_service),
+                          ml_service: MLService = Depends(get_ml_service)):
     """Analizar mensaje sin generar respuesta"""
     try:
-        # Analizar contexto con ML
-        context = await ml_service.analyze_context(message_data.message)
-        
-        # Analizar sentimiento
-        sentiment = await ai_service.analyze_sentiment(message_data.message)
-        
-        # Extraer palabras clave
-        keywords = await ai_service.extract_keywords(message_data.message)
+        # Contexto ML, sentimiento y palabras clave son independientes: se ejecutan en paralelo
+        context, sentiment, keywords = await asyncio.gather(
+            ml_service.analyze_context(message_data.message),
+            ai_service.analyze_sentiment(message_data.message),
+            ai_service.extract_keywords(message_data.message)
+        )
         
         return {
             "message": message_data.message,
@@ -184,9 +227,28 @@ async def submit_feedback(feedback_data: Dict[str, Any]):
 async def get_session_stats(session_id: str):
     """Obtener estadísticas de la sesión"""
     try:
-        history = db_manager.get_conversation_history(session_id, limit=100)
+        def count_session():
+            # Una sola pasada: conteos y suma de confianza sin listas intermedias
+            message_count = 0
+            confidence_sum = 0.0
+            topic_counts: Dict[str, int] = defaultdict(int)
+            emotion_counts: Dict[str, int] = defaultdict(int)
+            
+            for confidence, context in db_manager.iter_conversation_stats(session_id, limit=100):
+                message_count += 1
+                confidence_sum += confidence or 0
+                if context:
+                    for topic in context.get("keywords") or []:
+                        topic_counts[topic] += 1
+                    for emotion in context.get("emotions", {}).get("emotions") or []:
+                        emotion_counts[emotion] += 1
+            
+            return message_count, confidence_sum, topic_counts, emotion_counts
+        
+        # La lectura y decodificación de las filas se hace fuera del event loop
+        message_count, confidence_sum, topic_counts, emotion_counts = await asyncio.to_thread(count_session)
         
-        if not history:
+        if not message_count:
             return {
                 "session_id": session_id,
                 "message_count": 0,
@@ -195,33 +257,15 @@ async def get_session_stats(session_id: str):
                 "emotions": []
             }
         
-        # Calcular estadísticas
-        message_count = len(history)
-        avg_confidence = sum(msg.get("confidence", 0) for msg in history) / message_count
-        
-        # Extraer temas y emociones
-        all_topics = []
-        all_emotions = []
-        
-        for msg in history:
-            if msg.get("context"):
-                context = msg["context"]
-                if context.get("keywords"):
-                    all_topics.extend(context["keywords"])
-                if context.get("emotions", {}).get("emotions"):
-                    all_emotions.extend(context["emotions"]["emotions"])
-        
-        # Contar frecuencia
-        from collections import Counter
-        topic_counts = Counter(all_topics)
-        emotion_counts = Counter(all_emotions)
+        top_topics = heapq.nlargest(5, topic_counts.items(), key=itemgetter(1))
+        top_emotions = heapq.nlargest(5, emotion_counts.items(), key=itemgetter(1))
         
         return {
             "session_id": session_id,
             "message_count": message_count,
-            "avg_confidence": round(avg_confidence, 2),
-            "topics": [{"topic": topic, "count": count} for topic, count in topic_counts.most_common(5)],
-            "emotions": [{"emotion": emotion, "count": count} for emotion, count in emotion_counts.most_common(5)]
+            "avg_confidence": round(confidence_sum / message_count, 2),
+            "topics": [{"topic": topic, "count": count} for topic, count in top_topics],
+            "emotions": [{"emotion": emotion, "count": count} for emotion, count in top_emotions]
         }
         
     except Exception as e:
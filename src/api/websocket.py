@@ -3,49 +3,84 @@ WebSocket endpoints para chat en tiempo real
 """
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from typing import List, Dict, Any
-import json
+from typing import Dict, Any, Optional, Tuple
+import orjson
 import asyncio
-from datetime import datetime
+import logging
+import numpy as np
+from collections import OrderedDict
 
-from src.services.ai_service import AIService
-from src.services.ml_service import MLService
+from src.services.ai_service import get_ai_service
+from src.services.ml_service import get_ml_service
+from src.core.clock import now_iso
+from src.core.config import get_settings
 from src.core.database import db_manager
+from src.core.db_writer import enqueue_conversation, load_history
+from src.core.ws_frames import receive_payload
+
+settings = get_settings()
+
+log = logging.getLogger("lenrodai.ws")
 
 # Crear router
 websocket_router = APIRouter()
 
-# Instancias de servicios
-ai_service = AIService()
-ml_service = MLService()
+# Predicción de la respuesta mientras el usuario escribe
+PREFETCH_MIN_RATIO = 0.8       # fracción de la longitud media de los mensajes de la sesión
+PREFETCH_DEFAULT_LENGTH = 40   # longitud media supuesta mientras la sesión no tiene mensajes
+PREFETCH_MIN_GROWTH = 1.2      # el texto parcial debe crecer un 20% para relanzar la predicción
+AVERAGE_LENGTHS_SIZE = 10_000  # sesiones con longitud media recordada (LRU)
 
 # Conexiones WebSocket activas
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: set[WebSocket] = set()
         self.connection_sessions: Dict[WebSocket, str] = {}
+        self.pending_predictions: Dict[WebSocket, Tuple[str, asyncio.Task]] = {}
+        self.average_lengths: OrderedDict[Optional[str], float] = OrderedDict()
     
     async def connect(self, websocket: WebSocket, session_id: str = None):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
         if session_id:
             self.connection_sessions[websocket] = session_id
     
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        if websocket in self.connection_sessions:
-            del self.connection_sessions[websocket]
+        self.active_connections.discard(websocket)
+        self.connection_sessions.pop(websocket, None)
+        self.cancel_prediction(websocket)
+    
+    def record_length(self, session_id: Optional[str], length: int):
+        """Actualizar la longitud media de los mensajes de la sesión (media exponencial)"""
+        previous_length = self.average_lengths.get(session_id)
+        self.average_lengths[session_id] = (
+            length if previous_length is None
+            else 0.7 * previous_length + 0.3 * length
+        )
+        self.average_lengths.move_to_end(session_id)
+        if len(self.average_lengths) > AVERAGE_LENGTHS_SIZE:
+            self.average_lengths.popitem(last=False)
+    
+    def cancel_prediction(self, websocket: WebSocket):
+        pending = self.pending_predictions.pop(websocket, None)
+        if pending is not None:
+            pending[1].cancel()
     
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+    async def send_personal_message(self, message: Dict[str, Any], websocket: WebSocket):
+        # El contexto de ML puede traer escalares de numpy
+        await websocket.send_bytes(orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY))
     
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                # Remover conexiones que fallan
+    async def broadcast(self, payload: Dict[str, Any]):
+        # Se serializa una sola vez y los envíos se solapan en lugar de encadenarse
+        data = orjson.dumps(payload)
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_bytes(data) for connection in connections),
+            return_exceptions=True
+        )
+        # Remover conexiones que fallan
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
                 self.disconnect(connection)
 
 # Instancia del gestor de conexiones
@@ -58,21 +93,32 @@ async def websocket_chat(websocket: WebSocket, session_id: str = None):
     
     try:
         while True:
-            # Recibir mensaje del cliente
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            # Frames de más de MAX_WS_MESSAGE_BYTES cierran la conexión con 1009
+            message_data = orjson.loads(await receive_payload(websocket))
             
             # Procesar mensaje
             response = await process_websocket_message(message_data, websocket)
             
             # Enviar respuesta
-            await manager.send_personal_message(json.dumps(response), websocket)
+            await manager.send_personal_message(response, websocket)
             
     except WebSocketDisconnect:
+        pass
+    except Exception:
+        log.exception("Error en WebSocket")
+    finally:
         manager.disconnect(websocket)
-    except Exception as e:
-        print(f"Error en WebSocket: {e}")
-        manager.disconnect(websocket)
+
+# Plantillas de las respuestas frecuentes: se copian y solo se rellenan los campos dinámicos
+TYPING_TEMPLATE = {"type": "typing", "is_typing": False, "user_id": "", "timestamp": ""}
+ERROR_TEMPLATE = {"type": "error", "message": "", "timestamp": ""}
+
+def error_response(message: str) -> Dict[str, Any]:
+    """Respuesta de error a partir de la plantilla"""
+    response = ERROR_TEMPLATE.copy()
+    response["message"] = message
+    response["timestamp"] = now_iso()
+    return response
 
 async def process_websocket_message(message_data: Dict[str, Any], websocket: WebSocket) -> Dict[str, Any]:
     """Procesar mensaje del WebSocket"""
@@ -82,44 +128,51 @@ async def process_websocket_message(message_data: Dict[str, Any], websocket: Web
         session_id = message_data.get("session_id") or manager.connection_sessions.get(websocket)
         
         if message_type == "message":
-            return await handle_chat_message(user_message, session_id, message_data)
+            return await handle_chat_message(user_message, session_id, message_data, websocket)
         elif message_type == "typing":
-            return await handle_typing_indicator(message_data)
+            return await handle_typing_indicator(message_data, session_id, websocket)
         elif message_type == "context_update":
             return await handle_context_update(message_data, session_id)
         else:
-            return {
-                "type": "error",
-                "message": f"Tipo de mensaje no reconocido: {message_type}",
-                "timestamp": datetime.now().isoformat()
-            }
+            return error_response(f"Tipo de mensaje no reconocido: {message_type}")
             
     except Exception as e:
-        return {
-            "type": "error",
-            "message": f"Error procesando mensaje: {str(e)}",
-            "timestamp": datetime.now().isoformat()
-        }
+        return error_response(f"Error procesando mensaje: {str(e)}")
 
-async def handle_chat_message(user_message: str, session_id: str, message_data: Dict[str, Any]) -> Dict[str, Any]:
+async def handle_chat_message(user_message: str, session_id: str, message_data: Dict[str, Any],
+                              websocket: WebSocket) -> Dict[str, Any]:
     """Manejar mensaje de chat"""
     try:
-        # Obtener historial de conversación
-        conversation_history = db_manager.get_conversation_history(session_id, limit=10) if session_id else []
+        ai_service = get_ai_service()
+        ml_service = get_ml_service()
         
-        # Analizar contexto con ML
-        context = await ml_service.analyze_context(user_message, conversation_history)
+        manager.record_length(session_id, len(user_message))
         
-        # Generar respuesta con IA
-        ai_response = await ai_service.generate_response(
-            user_message,
-            conversation_history,
-            context
+        # Obtener historial de conversación
+        conversation_history = (
+            await load_history(session_id, 10) if session_id else []
         )
         
+        # Análisis de ML en paralelo con la generación: el prompt solo usa "topics"/"personality",
+        # que el análisis no produce
+        context_task = asyncio.create_task(ml_service.analyze_context(user_message, conversation_history))
+        
+        # Reutilizar la respuesta adelantada mientras escribía o generarla en streaming
+        streamed = False
+        ai_response = await take_prediction(websocket, user_message)
+        if ai_response is None:
+            async for event in ai_service.stream_response(user_message, conversation_history):
+                if event["type"] == "delta":
+                    streamed = True
+                    await manager.send_personal_message(event, websocket)
+                else:
+                    ai_response = event["result"]
+        
+        context = await context_task
+        
         # Guardar conversación si hay session_id
         if session_id:
-            db_manager.save_conversation(
+            await enqueue_conversation(
                 session_id=session_id,
                 user_message=user_message,
                 ai_response=ai_response["message"],
@@ -127,13 +180,18 @@ async def handle_chat_message(user_message: str, session_id: str, message_data:
                 confidence=ai_response.get("confidence", 0.8)
             )
         
+        if streamed and "error" in ai_response:
+            # El cliente ya muestra un mensaje parcial: el error lo descarta
+            return error_response(ai_response["message"])
+        
         return {
-            "type": "response",
+            # Tras los fragmentos, "done" cierra el mensaje; sin streaming va completo
+            "type": "done" if streamed else "response",
             "message": ai_response["message"],
             "session_id": session_id,
             "confidence": ai_response.get("confidence", 0.8),
             "context": context,
-            "timestamp": ai_response.get("timestamp", datetime.now().isoformat()),
+            "timestamp": ai_response.get("timestamp", now_iso()),
             "model_info": {
                 "model": ai_response.get("model", "unknown"),
                 "usage": ai_response.get("usage", {})
@@ -141,36 +199,88 @@ async def handle_chat_message(user_message: str, session_id: str, message_data:
         }
         
     except Exception as e:
-        return {
-            "type": "error",
-            "message": f"Error procesando mensaje: {str(e)}",
-            "timestamp": datetime.now().isoformat()
-        }
+        return error_response(f"Error procesando mensaje: {str(e)}")
 
-async def handle_typing_indicator(message_data: Dict[str, Any]) -> Dict[str, Any]:
+async def handle_typing_indicator(message_data: Dict[str, Any], session_id: str,
+                                  websocket: WebSocket) -> Dict[str, Any]:
     """Manejar indicador de escritura"""
     is_typing = message_data.get("is_typing", False)
     user_id = message_data.get("user_id", "unknown")
+    partial_text = message_data.get("partial_text", "").strip()
     
-    return {
-        "type": "typing",
-        "is_typing": is_typing,
-        "user_id": user_id,
-        "timestamp": datetime.now().isoformat()
-    }
+    if is_typing and partial_text:
+        schedule_prediction(websocket, session_id, partial_text)
+    
+    response = TYPING_TEMPLATE.copy()
+    response["is_typing"] = is_typing
+    response["user_id"] = user_id
+    response["timestamp"] = now_iso()
+    return response
+
+def schedule_prediction(websocket: WebSocket, session_id: str, partial_text: str):
+    """Adelantar la respuesta con el texto parcial cuando el mensaje parece casi completo"""
+    average_length = manager.average_lengths.get(session_id, PREFETCH_DEFAULT_LENGTH)
+    if len(partial_text) < PREFETCH_MIN_RATIO * average_length:
+        return
+    
+    # Cada pulsación envía un evento: solo se relanza si el texto creció lo suficiente
+    pending = manager.pending_predictions.get(websocket)
+    if pending is not None and len(partial_text) < PREFETCH_MIN_GROWTH * len(pending[0]):
+        return
+    
+    manager.cancel_prediction(websocket)
+    task = asyncio.create_task(predict_response(session_id, partial_text))
+    manager.pending_predictions[websocket] = (partial_text, task)
+
+async def predict_response(session_id: str, partial_text: str) -> Dict[str, Any]:
+    """Generar la respuesta adelantada con el historial de la sesión"""
+    conversation_history = (
+        await load_history(session_id, 10) if session_id else []
+    )
+    return await get_ai_service().generate_response(partial_text, conversation_history, {})
+
+async def take_prediction(websocket: WebSocket, user_message: str) -> Optional[Dict[str, Any]]:
+    """Reutilizar la respuesta adelantada si el mensaje final equivale al texto parcial"""
+    pending = manager.pending_predictions.pop(websocket, None)
+    if pending is None:
+        return None
+    
+    partial_text, task = pending
+    if partial_text == user_message.strip():
+        # Mismo texto: conviene esperarla aunque siga en curso
+        # wait no propaga el error de la predicción; la cancelación del propio handler sí
+        await asyncio.wait({task})
+        if task.cancelled() or task.exception() is not None:
+            # Si la predicción falló o se canceló, se genera la respuesta normalmente
+            return None
+        result = task.result()
+    elif task.done() and not task.cancelled() and task.exception() is None \
+            and await is_equivalent_message(partial_text, user_message):
+        result = task.result()
+    else:
+        task.cancel()
+        return None
+    
+    return None if "error" in result else result
+
+async def is_equivalent_message(partial_text: str, user_message: str) -> bool:
+    """Comparar los mensajes con el mismo umbral de similitud que la caché semántica"""
+    ai_service = get_ai_service()
+    partial_embedding = await ai_service.embed(partial_text)
+    message_embedding = await ai_service.embed(user_message)
+    if partial_embedding is None or message_embedding is None:
+        return False
+    return float(np.dot(partial_embedding, message_embedding)) >= settings.CACHE_SIM_THRESHOLD
 
 async def handle_context_update(message_data: Dict[str, Any], session_id: str) -> Dict[str, Any]:
     """Manejar actualización de contexto"""
     try:
         if not session_id:
-            return {
-                "type": "error",
-                "message": "Session ID requerido para actualizar contexto",
-                "timestamp": datetime.now().isoformat()
-            }
+            return error_response("Session ID requerido para actualizar contexto")
         
         # Actualizar contexto del usuario
-        db_manager.update_user_context(
+        await asyncio.to_thread(
+            db_manager.update_user_context,
             session_id=session_id,
             preferences=message_data.get("preferences"),
             topics=message_data.get("topics"),
@@ -181,15 +291,11 @@ async def handle_context_update(message_data: Dict[str, Any], session_id: str) -
             "type": "context_updated",
             "message": "Contexto actualizado correctamente",
             "session_id": session_id,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now_iso()
         }
         
     except Exception as e:
-        return {
-            "type": "error",
-            "message": f"Error actualizando contexto: {str(e)}",
-            "timestamp": datetime.now().isoformat()
-        }
+        return error_response(f"Error actualizando contexto: {str(e)}")
 
 @websocket_router.websocket("/admin")
 async def websocket_admin(websocket: WebSocket):
@@ -198,17 +304,17 @@ async def websocket_admin(websocket: WebSocket):
     
     try:
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            message_data = orjson.loads(await receive_payload(websocket))
             
             # Procesar comandos de administración
             response = await handle_admin_command(message_data)
-            await manager.send_personal_message(json.dumps(response), websocket)
+            await manager.send_personal_message(response, websocket)
             
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
-    except Exception as e:
-        print(f"Error en WebSocket admin: {e}")
+        pass
+    except Exception:
+        log.exception("Error en WebSocket admin")
+    finally:
         manager.disconnect(websocket)
 
 async def handle_admin_command(message_data: Dict[str, Any]) -> Dict[str, Any]:
@@ -222,29 +328,21 @@ async def handle_admin_command(message_data: Dict[str, Any]) -> Dict[str, Any]:
             return await get_connection_stats()
         elif command == "broadcast":
             message = message_data.get("message", "")
-            await manager.broadcast(json.dumps({
+            await manager.broadcast({
                 "type": "admin_broadcast",
                 "message": message,
-                "timestamp": datetime.now().isoformat()
-            }))
+                "timestamp": now_iso()
+            })
             return {
                 "type": "broadcast_sent",
                 "message": "Mensaje enviado a todas las conexiones",
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now_iso()
             }
         else:
-            return {
-                "type": "error",
-                "message": f"Comando no reconocido: {command}",
-                "timestamp": datetime.now().isoformat()
-            }
+            return error_response(f"Comando no reconocido: {command}")
             
     except Exception as e:
-        return {
-            "type": "error",
-            "message": f"Error procesando comando: {str(e)}",
-            "timestamp": datetime.now().isoformat()
-        }
+        return error_response(f"Error procesando comando: {str(e)}")
 
 async def get_admin_stats() -> Dict[str, Any]:
     """Obtener estadísticas de administración"""
@@ -253,7 +351,7 @@ async def get_admin_stats() -> Dict[str, Any]:
         "stats": {
             "active_connections": len(manager.active_connections),
             "total_sessions": len(manager.connection_sessions),
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now_iso()
         }
     }
 
@@ -264,9 +362,10 @@ async def get_connection_stats() -> Dict[str, Any]:
         "connections": [
             {
                 "session_id": session_id,
-                "connected_at": datetime.now().isoformat()
+                "client": f"{websocket.client.host}:{websocket.client.port}" if websocket.client else None,
+                "connected_at": now_iso()
             }
-            for session_id in manager.connection_sessions.values()
+            for websocket, session_id in manager.connection_sessions.items()
         ],
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now_iso()
     }
@@ -0,0 +1,22 @@
+"""
+Reloj compartido de baja resolución
+"""
+
+import asyncio
+from datetime import datetime
+
+# Resolución del timestamp compartido en segundos
+CLOCK_RESOLUTION = 0.05
+
+_now_iso: str = datetime.now().isoformat(timespec="milliseconds")
+
+def now_iso() -> str:
+    """Timestamp ISO actual, con una resolución de CLOCK_RESOLUTION"""
+    return _now_iso
+
+async def run_clock():
+    """Refrescar el timestamp compartido en segundo plano"""
+    global _now_iso
+    while True:
+        _now_iso = datetime.now().isoformat(timespec="milliseconds")
+        await asyncio.sleep(CLOCK_RESOLUTION)
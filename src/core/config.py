@@ -3,32 +3,66 @@ Configuración de la aplicación
 """
 
 import os
+from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import Optional
 
+def _env(name: str, default: str):
+    return field(default_factory=lambda: os.getenv(name, default))
+
+def _env_int(name: str, default: str):
+    return field(default_factory=lambda: int(os.getenv(name, default)))
+
+def _env_float(name: str, default: str):
+    return field(default_factory=lambda: float(os.getenv(name, default)))
+
+def _env_bool(name: str, default: str):
+    return field(default_factory=lambda: os.getenv(name, default).lower() == "true")
+
+@dataclass(frozen=True)
 class Settings:
-    """Configuración de la aplicación"""
+    """Configuración de la aplicación (inmutable, se lee del entorno una sola vez)"""
+    
+    # OpenAI
+    OPENAI_API_KEY: str = _env("OPENAI_API_KEY", "")
+    MODEL_NAME: str = _env("MODEL_NAME", "gpt-4o-mini")
+    MAX_TOKENS: int = _env_int("MAX_TOKENS", "1000")
+    TEMPERATURE: float = _env_float("TEMPERATURE", "0.7")
     
-    def __init__(self):
-        # OpenAI
-        self.OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
-        self.MODEL_NAME: str = os.getenv("MODEL_NAME", "gpt-3.5-turbo")
-        self.MAX_TOKENS: int = int(os.getenv("MAX_TOKENS", "1000"))
-        self.TEMPERATURE: float = float(os.getenv("TEMPERATURE", "0.7"))
-        
-        # FastAPI
-        self.HOST: str = os.getenv("HOST", "0.0.0.0")
-        self.PORT: int = int(os.getenv("PORT", "8000"))
-        self.DEBUG: bool = os.getenv("DEBUG", "True").lower() == "true"
-        
-        # Base de datos
-        self.DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./chatbot.db")
-        
-        # Seguridad
-        self.SECRET_KEY: str = os.getenv("SECRET_KEY", "your-secret-key-here")
-        
-        # Modelo ML
-        self.ML_MODEL_PATH: str = os.getenv("ML_MODEL_PATH", "./models/")
-        self.SENTENCE_TRANSFORMER_MODEL: str = os.getenv("SENTENCE_TRANSFORMER_MODEL", "all-MiniLM-L6-v2")
+    # FastAPI
+    HOST: str = _env("HOST", "0.0.0.0")
+    PORT: int = _env_int("PORT", "8000")
+    DEBUG: bool = _env_bool("DEBUG", "True")
+    # Procesos de Uvicorn: cada uno tiene sus propias cachés y modelos en memoria
+    WORKERS: int = _env_int("WORKERS", str(min(4, os.cpu_count() or 1)))
+    # permessage-deflate: menos ancho de banda en difusiones grandes a cambio de CPU por frame
+    WS_COMPRESS: bool = _env_bool("WS_COMPRESS", "False")
+    
+    # Base de datos
+    DATABASE_URL: str = _env("DATABASE_URL", "sqlite:///./chatbot.db")
+    
+    # Seguridad
+    SECRET_KEY: str = _env("SECRET_KEY", "your-secret-key-here")
+    
+    # Modelo ML
+    ML_MODEL_PATH: str = _env("ML_MODEL_PATH", "./models/")
+    SENTENCE_TRANSFORMER_MODEL: str = _env("SENTENCE_TRANSFORMER_MODEL", "all-MiniLM-L6-v2")
+    # Embeddings con el modelo exportado a ONNX y cuantizado a int8 (requiere requirements-quantize.txt)
+    ML_QUANTIZE: bool = _env_bool("ML_QUANTIZE", "False")
+    # Procesos para la inferencia de analyze_context (0 = hilos); p. ej. núcleos - 1 con WORKERS=1
+    ML_PROCESS_WORKERS: int = _env_int("ML_PROCESS_WORKERS", "0")
+    
+    # Caché semántica de respuestas
+    CACHE_SIM_THRESHOLD: float = _env_float("CACHE_SIM_THRESHOLD", "0.9")
+    # Ruta base: se guardan <ruta>.npy (embeddings) y <ruta>.msgpack (respuestas)
+    SEMANTIC_CACHE_PATH: str = _env("SEMANTIC_CACHE_PATH", "./models/semantic_cache")
+    # Reutilizar respuestas de chat con los mismos mensajes (con TEMPERATURE > 0 repite la misma respuesta)
+    CACHE_CHAT_RESPONSES: bool = _env_bool("CACHE_CHAT_RESPONSES", "False")
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Configuración compartida; también sirve como dependencia de FastAPI"""
+    return Settings()
 
 # Instancia global de configuración
-settings = Settings()
+settings = get_settings()
@@ -2,95 +2,232 @@
 Configuración de base de datos
 """
 
+import os
 import sqlite3
 import json
+import msgspec
+import numpy as np
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Any, Optional
-from src.core.config import settings
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+from src.core.config import get_settings
+
+settings = get_settings()
+
+def encode_numpy(obj: Any) -> Any:
+    """Convertir escalares y arrays de numpy (del análisis de ML) a tipos nativos"""
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise NotImplementedError(f"Tipo no serializable: {type(obj)}")
+
+# Columnas JSON guardadas como BLOB msgpack: codificación en C y filas más pequeñas
+blob_encoder = msgspec.msgpack.Encoder(enc_hook=encode_numpy)
+blob_decoder = msgspec.msgpack.Decoder()
+
+# Caché del contexto de usuario: cambia poco y se lee en cada turno
+CTX_TTL = 30.0
+CTX_CACHE_SIZE = 10_000
 
 class DatabaseManager:
     """Gestor de base de datos para el chatbot"""
     
     def __init__(self):
         self.db_path = settings.DATABASE_URL.replace("sqlite:///", "")
+        # El fichero puede vivir en un directorio de datos (p. ej. el volumen de docker-compose)
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        # Conexión de escritura de larga vida, compartida entre hilos y serializada con el lock
+        self.conn = self.connect()
+        self.write_lock = threading.RLock()
+        # Lecturas en una conexión por hilo: con WAL no esperan a los escritores
+        self.readers = threading.local()
+        # Todas las conexiones de lectura abiertas, para cerrarlas desde cualquier hilo
+        self.reader_conns: List[sqlite3.Connection] = []
+        self.readers_lock = threading.Lock()
+        # Se usa desde hilos (asyncio.to_thread): la caché solo se toca con el lock
+        self.ctx_cache: OrderedDict[str, Tuple[float, Dict]] = OrderedDict()
+        self.ctx_lock = threading.Lock()
+        # Se incrementa con cada actualización: una lectura que empezó antes no cachea su resultado
+        self.ctx_generation = 0
         self.init_db()
     
+    def connect(self) -> sqlite3.Connection:
+        """Abrir una conexión con los PRAGMA de rendimiento"""
+        # isolation_level=None: las transacciones se abren explícitamente con BEGIN
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        # synchronous, temp_store y cache_size son por conexión
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        return conn
+    
+    def reader(self) -> sqlite3.Connection:
+        """Conexión de lectura del hilo actual, abierta una sola vez"""
+        conn = getattr(self.readers, "conn", None)
+        if conn is None:
+            conn = self.readers.conn = self.connect()
+            with self.readers_lock:
+                self.reader_conns.append(conn)
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        """Transacción de escritura sobre la conexión compartida"""
+        with self.write_lock:
+            # IMMEDIATE: el bloqueo de escritura se toma al empezar y no a mitad de la transacción
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn.cursor()
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+    
+    def close(self):
+        """Cerrar la conexión de escritura y las de lectura de todos los hilos"""
+        with self.write_lock:
+            self.conn.close()
+        with self.readers_lock:
+            for reader in self.reader_conns:
+                reader.close()
+            self.reader_conns.clear()
+        self.readers = threading.local()
+    
     def init_db(self):
         """Inicializar base de datos"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.write_lock:
+            # WAL es persistente en el fichero: lectores y escritores no se bloquean y cada commit hace menos fsync
+            self.conn.execute("PRAGMA journal_mode=WAL")
         
-        # Tabla de conversaciones
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT NOT NULL,
-                user_message TEXT NOT NULL,
-                ai_response TEXT NOT NULL,
-                context TEXT,
-                confidence REAL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        with self.transaction() as cursor:
+            # Tabla de conversaciones
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    user_message TEXT NOT NULL,
+                    ai_response TEXT NOT NULL,
+                    context BLOB,
+                    confidence REAL,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # Tabla de sesiones
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    message_count INTEGER DEFAULT 0
+                )
+            """)
+            
+            # Tabla de contexto de usuario
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS user_context (
+                    session_id TEXT PRIMARY KEY,
+                    preferences BLOB,
+                    topics BLOB,
+                    personality_profile BLOB,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # Índices: el historial se lee por sesión y en orden inverso sin ordenar la tabla
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_conv_session_ts
+                ON conversations(session_id, timestamp DESC)
+            """)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_sessions_last
+                ON sessions(last_activity)
+            """)
+            
+            self.migrate_json_columns(cursor)
+            
+            # Estadísticas para el planificador, solo la primera vez
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                cursor.execute("ANALYZE")
+    
+    def migrate_json_columns(self, cursor: sqlite3.Cursor):
+        """Recodificar a msgpack las filas guardadas como texto JSON en versiones anteriores"""
+        def reencode(value):
+            return blob_encoder.encode(json.loads(value)) if value else None
         
-        # Tabla de sesiones
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS sessions (
-                id TEXT PRIMARY KEY,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
-                message_count INTEGER DEFAULT 0
-            )
-        """)
+        cursor.execute("SELECT id, context FROM conversations WHERE typeof(context) = 'text'")
+        rows = [(reencode(context), row_id) for row_id, context in cursor.fetchall()]
+        cursor.executemany("UPDATE conversations SET context = ? WHERE id = ?", rows)
         
-        # Tabla de contexto de usuario
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS user_context (
-                session_id TEXT PRIMARY KEY,
-                preferences TEXT,
-                topics TEXT,
-                personality_profile TEXT,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
+            SELECT session_id, preferences, topics, personality_profile
+            FROM user_context
+            WHERE typeof(preferences) = 'text' OR typeof(topics) = 'text' OR typeof(personality_profile) = 'text'
         """)
-        
-        conn.commit()
-        conn.close()
+        rows = []
+        for session_id, *columns in cursor.fetchall():
+            values = [reencode(value) if isinstance(value, str) else value for value in columns]
+            rows.append((*values, session_id))
+        cursor.executemany("""
+            UPDATE user_context SET preferences = ?, topics = ?, personality_profile = ?
+            WHERE session_id = ?
+        """, rows)
     
     def save_conversation(self, session_id: str, user_message: str, 
                          ai_response: str, context: Dict = None, 
                          confidence: float = 0.0) -> int:
         """Guardar conversación"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO conversations 
-            (session_id, user_message, ai_response, context, confidence)
-            VALUES (?, ?, ?, ?, ?)
-        """, (session_id, user_message, ai_response, 
-              json.dumps(context) if context else None, confidence))
-        
-        conversation_id = cursor.lastrowid
-        
-        # Actualizar sesión
-        cursor.execute("""
-            INSERT OR REPLACE INTO sessions (id, last_activity, message_count)
-            VALUES (?, CURRENT_TIMESTAMP, 
-                   COALESCE((SELECT message_count FROM sessions WHERE id = ?), 0) + 1)
-        """, (session_id, session_id))
-        
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute("""
+                INSERT INTO conversations 
+                (session_id, user_message, ai_response, context, confidence)
+                VALUES (?, ?, ?, ?, ?)
+            """, (session_id, user_message, ai_response, 
+                  blob_encoder.encode(context) if context else None, confidence))
+            
+            conversation_id = cursor.lastrowid
+            
+            # Actualizar sesión
+            cursor.execute("""
+                INSERT OR REPLACE INTO sessions (id, last_activity, message_count)
+                VALUES (?, CURRENT_TIMESTAMP, 
+                       COALESCE((SELECT message_count FROM sessions WHERE id = ?), 0) + 1)
+            """, (session_id, session_id))
         
         return conversation_id
     
+    def save_conversations(self, conversations: List[Dict[str, Any]]):
+        """Guardar un lote de conversaciones en una sola transacción"""
+        rows = []
+        session_counts: Dict[str, int] = defaultdict(int)
+        for conversation in conversations:
+            context = conversation.get("context")
+            rows.append((conversation["session_id"], conversation["user_message"], conversation["ai_response"],
+                         blob_encoder.encode(context) if context else None, conversation.get("confidence", 0.0)))
+            session_counts[conversation["session_id"]] += 1
+        
+        with self.transaction() as cursor:
+            cursor.executemany("""
+                INSERT INTO conversations 
+                (session_id, user_message, ai_response, context, confidence)
+                VALUES (?, ?, ?, ?, ?)
+            """, rows)
+            
+            # Una sola actualización por sesión con el total del lote
+            cursor.executemany("""
+                INSERT INTO sessions (id, last_activity, message_count)
+                VALUES (?, CURRENT_TIMESTAMP, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    last_activity = CURRENT_TIMESTAMP,
+                    message_count = message_count + excluded.message_count
+            """, session_counts.items())
+    
     def get_conversation_history(self, session_id: str, limit: int = 10) -> List[Dict]:
         """Obtener historial de conversación"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
+        cursor = self.reader().execute("""
             SELECT user_message, ai_response, context, confidence, timestamp
             FROM conversations 
             WHERE session_id = ? 
@@ -103,54 +240,87 @@ class DatabaseManager:
             results.append({
                 "user_message": row[0],
                 "ai_response": row[1],
-                "context": json.loads(row[2]) if row[2] else None,
+                "context": blob_decoder.decode(row[2]) if row[2] else None,
                 "confidence": row[3],
                 "timestamp": row[4]
             })
         
-        conn.close()
         return results
     
+    def iter_conversation_stats(self, session_id: str, limit: int = 100) -> Iterator[Tuple[float, Optional[Dict]]]:
+        """Recorrer confianza y contexto de las conversaciones sin materializar el historial"""
+        cursor = self.reader().execute("""
+            SELECT confidence, context
+            FROM conversations 
+            WHERE session_id = ? 
+            ORDER BY timestamp DESC 
+            LIMIT ?
+        """, (session_id, limit))
+        try:
+            for confidence, context in cursor:
+                yield confidence, blob_decoder.decode(context) if context else None
+        finally:
+            cursor.close()
+    
+    def get_user_messages(self, limit: int = 5000) -> List[str]:
+        """Mensajes de usuario más recientes, como corpus para los modelos"""
+        cursor = self.reader().execute("""
+            SELECT user_message FROM conversations ORDER BY id DESC LIMIT ?
+        """, (limit,))
+        return [row[0] for row in cursor.fetchall()]
+    
     def update_user_context(self, session_id: str, preferences: Dict = None,
                            topics: List[str] = None, personality: Dict = None):
         """Actualizar contexto del usuario"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.transaction() as cursor:
+            cursor.execute("""
+                INSERT OR REPLACE INTO user_context 
+                (session_id, preferences, topics, personality_profile)
+                VALUES (?, ?, ?, ?)
+            """, (session_id, 
+                  blob_encoder.encode(preferences) if preferences else None,
+                  blob_encoder.encode(topics) if topics else None,
+                  blob_encoder.encode(personality) if personality else None))
         
-        cursor.execute("""
-            INSERT OR REPLACE INTO user_context 
-            (session_id, preferences, topics, personality_profile)
-            VALUES (?, ?, ?, ?)
-        """, (session_id, 
-              json.dumps(preferences) if preferences else None,
-              json.dumps(topics) if topics else None,
-              json.dumps(personality) if personality else None))
-        
-        conn.commit()
-        conn.close()
+        # Tras el commit se invalida y se sube la generación: una lectura que empezó antes no cachea el valor anterior
+        with self.ctx_lock:
+            self.ctx_generation += 1
+            self.ctx_cache.pop(session_id, None)
     
     def get_user_context(self, session_id: str) -> Dict:
         """Obtener contexto del usuario"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Otros workers pueden actualizarlo: como mucho se sirve CTX_TTL segundos desactualizado
+        with self.ctx_lock:
+            cached = self.ctx_cache.get(session_id)
+            generation = self.ctx_generation
+        if cached is not None and time.monotonic() - cached[0] < CTX_TTL:
+            return cached[1]
         
-        cursor.execute("""
+        row = self.reader().execute("""
             SELECT preferences, topics, personality_profile
             FROM user_context 
             WHERE session_id = ?
-        """, (session_id,))
-        
-        row = cursor.fetchone()
-        conn.close()
+        """, (session_id,)).fetchone()
         
         if row:
-            return {
-                "preferences": json.loads(row[0]) if row[0] else {},
-                "topics": json.loads(row[1]) if row[1] else [],
-                "personality": json.loads(row[2]) if row[2] else {}
+            context = {
+                "preferences": blob_decoder.decode(row[0]) if row[0] else {},
+                "topics": blob_decoder.decode(row[1]) if row[1] else [],
+                "personality": blob_decoder.decode(row[2]) if row[2] else {}
             }
+        else:
+            context = {"preferences": {}, "topics": [], "personality": {}}
         
-        return {"preferences": {}, "topics": [], "personality": {}}
+        with self.ctx_lock:
+            if generation != self.ctx_generation:
+                # Hubo una actualización durante la lectura: puede ser el valor anterior, no se cachea
+                return context
+            self.ctx_cache[session_id] = (time.monotonic(), context)
+            self.ctx_cache.move_to_end(session_id)
+            if len(self.ctx_cache) > CTX_CACHE_SIZE:
+                # Se descarta la entrada más antigua
+                self.ctx_cache.popitem(last=False)
+        return context
 
 # Instancia global del gestor de base de datos
 db_manager = DatabaseManager()
@@ -0,0 +1,118 @@
+"""
+Escritura de conversaciones en segundo plano
+"""
+
+import asyncio
+import logging
+from collections import Counter
+from typing import Dict, Any, List, Optional
+from src.core.database import db_manager
+
+log = logging.getLogger("lenrodai.db")
+
+# Un lote se escribe al llegar a WRITE_BATCH_SIZE conversaciones o tras WRITE_FLUSH_INTERVAL segundos
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 0.1
+
+WRITE_QUEUE_SIZE = 10000
+
+# Cola y condición se crean en start_writer, dentro del loop que las usa (en 3.9 se ligan al loop al crearse)
+write_queue: Optional[asyncio.Queue] = None
+writes_done: Optional[asyncio.Condition] = None
+writer_task: Optional[asyncio.Task] = None
+
+# Conversaciones de cada sesión aún sin escribir (en la cola o en el lote en curso)
+pending_sessions: Counter = Counter()
+
+def start_writer():
+    """Crear la cola en el loop actual y lanzar el escritor en segundo plano (al arrancar)"""
+    global write_queue, writes_done, writer_task
+    write_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    writes_done = asyncio.Condition()
+    writer_task = asyncio.create_task(drain_writes())
+
+async def stop_writer():
+    """Detener el escritor y guardar lo que quede pendiente (al cerrar)"""
+    if writer_task is not None:
+        writer_task.cancel()
+        # Se espera a que el escritor guarde el lote que ya había sacado de la cola
+        await asyncio.gather(writer_task, return_exceptions=True)
+    flush_writes()
+
+async def enqueue_conversation(session_id: str, user_message: str, ai_response: str,
+                               context: Dict = None, confidence: float = 0.0):
+    """Encolar una conversación para guardarla sin bloquear el event loop"""
+    conversation = {
+        "session_id": session_id,
+        "user_message": user_message,
+        "ai_response": ai_response,
+        "context": context,
+        "confidence": confidence
+    }
+    try:
+        if write_queue is None:
+            raise asyncio.QueueFull
+        write_queue.put_nowait(conversation)
+    except asyncio.QueueFull:
+        # Cola llena (o escritor sin arrancar): se guarda en un hilo antes que perder la conversación
+        await asyncio.to_thread(db_manager.save_conversations, [conversation])
+        return
+    pending_sessions[session_id] += 1
+
+async def load_history(session_id: str, limit: int = 10) -> List[Dict]:
+    """Historial de la sesión, esperando a que se escriban sus conversaciones pendientes"""
+    if pending_sessions[session_id]:
+        # Un mensaje rápido tras otro no debe responderse sin el turno anterior
+        async with writes_done:
+            await writes_done.wait_for(lambda: not pending_sessions[session_id])
+    return await asyncio.to_thread(db_manager.get_conversation_history, session_id, limit)
+
+async def mark_written(batch: List[Dict[str, Any]]):
+    """Descontar las conversaciones del lote y despertar a las lecturas en espera"""
+    async with writes_done:
+        for conversation in batch:
+            session_id = conversation["session_id"]
+            pending_sessions[session_id] -= 1
+            if pending_sessions[session_id] <= 0:
+                del pending_sessions[session_id]
+        writes_done.notify_all()
+
+async def drain_writes():
+    """Vaciar la cola en lotes, cada uno en una sola transacción"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch: List[Dict[str, Any]] = []
+        try:
+            batch.append(await write_queue.get())
+            deadline = loop.time() + WRITE_FLUSH_INTERVAL
+            while len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(write_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Al cerrar: las conversaciones ya sacadas de la cola no están en ella para flush_writes
+            if batch:
+                db_manager.save_conversations(batch)
+            raise
+        
+        # Si se cancela durante la escritura, el hilo termina de guardar el lote igualmente
+        try:
+            await asyncio.to_thread(db_manager.save_conversations, batch)
+        except Exception:
+            log.exception("Error guardando conversaciones: se pierden %d", len(batch))
+        finally:
+            await mark_written(batch)
+
+def flush_writes():
+    """Guardar lo que quede en la cola (al cerrar la aplicación)"""
+    if write_queue is None:
+        return
+    batch = []
+    while not write_queue.empty():
+        batch.append(write_queue.get_nowait())
+    if batch:
+        db_manager.save_conversations(batch)
@@ -0,0 +1,21 @@
+"""
+Recepción de frames WebSocket con límite de tamaño
+"""
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+# Tamaño máximo aceptado por frame antes de parsear el JSON, en bytes UTF-8
+MAX_WS_MESSAGE_BYTES = 8192
+
+async def receive_payload(websocket: WebSocket, max_bytes: int = MAX_WS_MESSAGE_BYTES) -> bytes:
+    """Recibir un frame como bytes UTF-8 (orjson/msgspec los parsean directamente) y aplicar el límite"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    # Los clientes pueden enviar el JSON como texto o como binario; el texto se mide ya codificado
+    data = message.get("bytes") or (message.get("text") or "").encode()
+    if len(data) > max_bytes:
+        # 1009: mensaje demasiado grande; se limpia como una desconexión normal
+        await websocket.close(code=1009)
+        raise WebSocketDisconnect(code=1009)
+    return data
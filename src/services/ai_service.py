@@ -3,12 +3,25 @@ Servicio de IA con OpenAI
 """
 
 import openai
+import re
 import json
 import asyncio
+import logging
+import numpy as np
 from datetime import datetime
-from typing import List, Dict, Any, Optional
-from src.core.config import settings
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
+from src.core.config import get_settings
 from src.core.database import db_manager
+from src.services.ml_service import get_ml_service
+from src.services.response_cache import ExactResponseCache, SemanticResponseCache
+
+settings = get_settings()
+log = logging.getLogger("lenrodai.ai")
+
+# Expresiones de incertidumbre, compiladas en una sola alternativa
+UNCERTAINTY_WORDS = ("no estoy seguro", "no sé", "tal vez", "posiblemente", "quizás")
+UNCERTAINTY_RE = re.compile("|".join(map(re.escape, UNCERTAINTY_WORDS)))
 
 class AIService:
     """Servicio para interactuar con OpenAI"""
@@ -18,6 +31,9 @@ class AIService:
         self.model = settings.MODEL_NAME
         self.max_tokens = settings.MAX_TOKENS
         self.temperature = settings.TEMPERATURE
+        self.semantic_cache = SemanticResponseCache(threshold=settings.CACHE_SIM_THRESHOLD)
+        # Respuestas exactas por hash de (modelo, parámetros, mensajes)
+        self.completion_cache = ExactResponseCache(maxsize=10_000, ttl=3600)
     
     async def initialize(self):
         """Inicializar cliente OpenAI"""
@@ -25,31 +41,19 @@ class AIService:
             raise ValueError("OPENAI_API_KEY no está configurada")
         
         self.client = openai.AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-        print("✅ Servicio OpenAI inicializado")
+        self.semantic_cache.load(settings.SEMANTIC_CACHE_PATH)
+        log.info("Servicio OpenAI inicializado")
     
     async def generate_response(self, user_message: str, 
                               conversation_history: List[Dict] = None,
                               context: Dict = None) -> Dict[str, Any]:
         """Generar respuesta usando OpenAI"""
         try:
-            # Construir mensajes del sistema
-            system_prompt = self._build_system_prompt(context)
-            messages = [{"role": "system", "content": system_prompt}]
-            
-            # Agregar historial de conversación
-            if conversation_history:
-                for msg in conversation_history[-10:]:  # Últimos 10 mensajes
-                    messages.append({
-                        "role": "user", 
-                        "content": msg.get("user_message", "")
-                    })
-                    messages.append({
-                        "role": "assistant", 
-                        "content": msg.get("ai_response", "")
-                    })
-            
-            # Agregar mensaje actual
-            messages.append({"role": "user", "content": user_message})
+            cached, embedding, messages, cache_key = await self._lookup_cached(
+                user_message, conversation_history, context
+            )
+            if cached is not None:
+                return cached
             
             # Llamar a OpenAI
             response = await self.client.chat.completions.create(
@@ -62,9 +66,9 @@ class AIService:
             )
             
             ai_response = response.choices[0].message.content
-            confidence = self._calculate_confidence(response)
+            confidence = self._calculate_confidence(ai_response, response.usage.total_tokens)
             
-            return {
+            result = {
                 "message": ai_response,
                 "confidence": confidence,
                 "timestamp": datetime.now().isoformat(),
@@ -75,6 +79,9 @@ class AIService:
                     "total_tokens": response.usage.total_tokens
                 }
             }
+            self._store_result(result, embedding, cache_key)
+            
+            return result
             
         except Exception as e:
             return {
@@ -84,6 +91,149 @@ class AIService:
                 "error": str(e)
             }
     
+    async def stream_response(self, user_message: str,
+                              conversation_history: List[Dict] = None,
+                              context: Dict = None) -> AsyncIterator[Dict[str, Any]]:
+        """Generar respuesta en streaming: eventos "delta" con cada fragmento y un "done" final con el resultado"""
+        try:
+            cached, embedding, messages, cache_key = await self._lookup_cached(
+                user_message, conversation_history, context
+            )
+            if cached is not None:
+                yield {"type": "delta", "content": cached["message"]}
+                yield {"type": "done", "result": cached}
+                return
+            
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                presence_penalty=0.1,
+                frequency_penalty=0.1,
+                stream=True
+            )
+            
+            parts = []
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    parts.append(content)
+                    yield {"type": "delta", "content": content}
+            
+            ai_response = "".join(parts)
+            # El streaming no informa del consumo de tokens en esta versión del SDK: se estima (~4 caracteres por token)
+            estimated_tokens = (sum(len(message["content"]) for message in messages) + len(ai_response)) // 4
+            result = {
+                "message": ai_response,
+                "confidence": self._calculate_confidence(ai_response, estimated_tokens),
+                "timestamp": datetime.now().isoformat(),
+                "model": self.model,
+                "usage": {}
+            }
+            self._store_result(result, embedding, cache_key)
+            
+            yield {"type": "done", "result": result}
+            
+        except Exception as e:
+            yield {"type": "done", "result": {
+                "message": f"Lo siento, hubo un error procesando tu mensaje: {str(e)}",
+                "confidence": 0.0,
+                "timestamp": datetime.now().isoformat(),
+                "error": str(e)
+            }}
+    
+    async def _lookup_cached(self, user_message: str, conversation_history: List[Dict] = None,
+                             context: Dict = None) -> Tuple[Optional[Dict[str, Any]], Optional[np.ndarray],
+                                                            List[Dict[str, str]], Optional[str]]:
+        """Buscar en las cachés semántica y exacta: (respuesta cacheada, embedding, mensajes, clave)"""
+        # Solo los mensajes sin historial ni contexto personalizado dependen únicamente del texto
+        embedding = None
+        if not conversation_history and not (context and (context.get("topics") or context.get("personality"))):
+            embedding = await self.embed(user_message)
+        if embedding is not None:
+            cached = self.semantic_cache.lookup(embedding)
+            if cached is not None:
+                return {**cached, "timestamp": datetime.now().isoformat(), "cache_hit": True}, embedding, [], None
+        
+        messages = self._build_messages(user_message, conversation_history, context)
+        cache_key = self._chat_cache_key(messages)
+        if cache_key is not None:
+            cached = self.completion_cache.get(cache_key)
+            if cached is not None:
+                return {**cached, "timestamp": datetime.now().isoformat(), "cache_hit": True}, embedding, messages, cache_key
+        
+        return None, embedding, messages, cache_key
+    
+    def _store_result(self, result: Dict[str, Any], embedding: Optional[np.ndarray], cache_key: Optional[str]):
+        """Guardar una respuesta nueva en las cachés que apliquen"""
+        if embedding is not None:
+            self.semantic_cache.add(embedding, result)
+        if cache_key is not None:
+            self.completion_cache.set(cache_key, result)
+    
+    async def embed(self, text: str) -> Optional[np.ndarray]:
+        """Embedding normalizado del mensaje con el Sentence Transformer del servicio ML"""
+        sentence_model = getattr(get_ml_service(), "sentence_model", None)
+        if sentence_model is None:
+            return None
+        try:
+            # encode es CPU intensivo: se ejecuta fuera del event loop
+            embedding = await asyncio.to_thread(sentence_model.encode, text, normalize_embeddings=True)
+            return np.asarray(embedding, dtype=np.float32)
+        except Exception as e:
+            log.warning("Error calculando embedding: %s", e)
+            return None
+    
+    def _chat_cache_key(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        """Clave de caché de una conversación, o None si la caché de chat está desactivada"""
+        if not settings.CACHE_CHAT_RESPONSES:
+            return None
+        return ExactResponseCache.make_key(self.model, self.temperature, self.max_tokens, messages)
+    
+    async def _cached_completion(self, messages: List[Dict[str, str]], max_tokens: int,
+                                 temperature: float) -> str:
+        """Completar con OpenAI reutilizando la respuesta de una petición idéntica"""
+        cache_key = ExactResponseCache.make_key(self.model, temperature, max_tokens, messages)
+        cached = self.completion_cache.get(cache_key)
+        if cached is not None:
+            return cached["content"]
+        
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        content = response.choices[0].message.content
+        self.completion_cache.set(cache_key, {"content": content})
+        return content
+    
+    def _build_messages(self, user_message: str, conversation_history: List[Dict] = None,
+                        context: Dict = None) -> List[Dict[str, str]]:
+        """Construir la lista de mensajes para OpenAI"""
+        # Construir mensajes del sistema
+        system_prompt = self._build_system_prompt(context)
+        messages = [{"role": "system", "content": system_prompt}]
+        
+        # Agregar historial de conversación
+        if conversation_history:
+            for msg in conversation_history[-10:]:  # Últimos 10 mensajes
+                messages.append({
+                    "role": "user", 
+                    "content": msg.get("user_message", "")
+                })
+                messages.append({
+                    "role": "assistant", 
+                    "content": msg.get("ai_response", "")
+                })
+        
+        # Agregar mensaje actual
+        messages.append({"role": "user", "content": user_message})
+        return messages
+    
     def _build_system_prompt(self, context: Dict = None) -> str:
         """Construir prompt del sistema"""
         base_prompt = """Eres un asistente de IA inteligente, sofisticado y profesional. 
@@ -114,33 +264,30 @@ class AIService:
         
         return base_prompt
     
-    def _calculate_confidence(self, response) -> float:
+    def _calculate_confidence(self, ai_response: str, total_tokens: int) -> float:
         """Calcular confianza basada en la respuesta"""
         # Análisis básico de confianza
         confidence = 0.8  # Base
         
         # Ajustar según tokens utilizados
-        if response.usage.total_tokens < 50:
+        if total_tokens < 50:
             confidence -= 0.1
-        elif response.usage.total_tokens > 500:
+        elif total_tokens > 500:
             confidence += 0.1
         
         # Ajustar según presencia de indicadores de incertidumbre
-        response_text = response.choices[0].message.content.lower()
-        uncertainty_words = ["no estoy seguro", "no sé", "tal vez", "posiblemente", "quizás"]
-        
-        for word in uncertainty_words:
-            if word in response_text:
-                confidence -= 0.1
+        response_text = ai_response.lower()
+        # Una sola pasada sobre el texto; cada expresión distinta resta una vez
+        confidence -= 0.1 * len(set(UNCERTAINTY_RE.findall(response_text)))
         
         return max(0.0, min(1.0, confidence))
     
     async def analyze_sentiment(self, text: str) -> Dict[str, Any]:
         """Analizar sentimiento del texto"""
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[
+            # Temperatura baja y salida estructurada: una petición repetida se sirve de la caché
+            content = await self._cached_completion(
+                [
                     {
                         "role": "system",
                         "content": "Analiza el sentimiento del siguiente texto y responde solo con un JSON que contenga: sentiment (positive/negative/neutral), confidence (0-1), emotions (lista de emociones detectadas)."
@@ -154,7 +301,7 @@ class AIService:
                 temperature=0.3
             )
             
-            result = json.loads(response.choices[0].message.content)
+            result = json.loads(content)
             return result
             
         except Exception as e:
@@ -168,9 +315,8 @@ class AIService:
     async def extract_keywords(self, text: str) -> List[str]:
         """Extraer palabras clave del texto"""
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[
+            content = await self._cached_completion(
+                [
                     {
                         "role": "system",
                         "content": "Extrae las palabras clave más importantes del siguiente texto. Responde solo con una lista de palabras separadas por comas."
@@ -184,7 +330,7 @@ class AIService:
                 temperature=0.3
             )
             
-            keywords = response.choices[0].message.content.split(",")
+            keywords = content.split(",")
             return [kw.strip() for kw in keywords if kw.strip()]
             
         except Exception as e:
@@ -192,6 +338,12 @@ class AIService:
     
     async def cleanup(self):
         """Limpiar recursos"""
+        self.semantic_cache.save(settings.SEMANTIC_CACHE_PATH)
         if self.client:
             # Cerrar conexiones si es necesario
             pass
+
+@lru_cache(maxsize=1)
+def get_ai_service() -> AIService:
+    """Instancia única del servicio de IA compartida por toda la aplicación"""
+    return AIService()
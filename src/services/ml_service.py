@@ -2,20 +2,141 @@
 Servicio de Machine Learning con TensorFlow
 """
 
+import asyncio
+import concurrent.futures
+import multiprocessing
 import numpy as np
 import tensorflow as tf
 from sentence_transformers import SentenceTransformer
 import nltk
 import spacy
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 from typing import List, Dict, Any, Optional, Tuple
-import pickle
+import joblib
 import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 import re
+import orjson
 
-from src.core.config import settings
+from src.core.config import get_settings
+
+settings = get_settings()
+
+# Caché de análisis de contexto
+CONTEXT_CACHE_TTL = 300.0
+CONTEXT_CACHE_SIZE = 1024
+# Mensajes del historial que intervienen en el análisis (ver calculate_similarity)
+SIMILARITY_HISTORY_WINDOW = 5
+# Corpus del TF-IDF: mensajes de usuario del historial
+TFIDF_CORPUS_SIZE = 5000
+TFIDF_MIN_CORPUS = 50
+# Reajuste en caliente: se comprueba cada TFIDF_REFIT_INTERVAL segundos y se reajusta
+# cuando el corpus ha crecido TFIDF_REFIT_GROWTH veces desde el último ajuste
+TFIDF_REFIT_INTERVAL = 300.0
+TFIDF_REFIT_GROWTH = 2
+# Embeddings de mensajes ya vistos: el historial se repite de un turno a otro
+EMBEDDING_CACHE_SIZE = 4096
+
+# Expresiones regulares compiladas una sola vez
+NON_WORD_RE = re.compile(r'[^a-zA-Záéíóúñü\s]')
+WHITESPACE_RE = re.compile(r'\s+')
+SENTENCE_SPLIT_RE = re.compile(r'[.!?]+')
+
+# Modelo de embeddings cuantizado (ML_QUANTIZE)
+QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+
+# Componentes de spaCy necesarios para extract_entities
+SPACY_PIPES = ("tok2vec", "ner")
+ENTITY_CACHE_SIZE = 4096
+
+# Palabras frecuentes del español para detect_language: búsqueda O(1) por palabra
+SPANISH_WORDS = frozenset({
+    "el", "la", "de", "que", "y", "en", "un", "es", "se", "no", "te", "lo", "le", "da", "su",
+    "por", "son", "con", "para", "al", "del", "los", "las", "una", "pero", "sus", "más", "como",
+    "todo", "esta", "sobre", "entre", "cuando", "muy", "sin", "hasta", "desde", "está", "mi",
+    "porque", "qué", "sólo", "han", "yo", "hay", "vez", "puede", "todos", "así", "nos", "ni",
+    "parte", "tiene", "él", "uno", "donde", "bien", "tiempo", "mismo", "ese", "ahora", "cada", "e",
+    "vida", "otro", "después", "otros", "aunque", "esa", "esos", "estas", "me", "antes", "estado",
+    "contra", "sí", "sino", "forma", "caso", "nada", "hacer", "general", "menos", "año", "mundo",
+    "aquí", "manera", "tanto", "cual", "mientras", "saber", "durante", "través"
+})
+
+class QuantizedSentenceEncoder:
+    """Sentence Transformer exportado a ONNX y cuantizado a int8 para inferencia en CPU"""
+    
+    def __init__(self, name: str, path: str):
+        # Dependencia opcional: solo se importa si se activa ML_QUANTIZE
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+        
+        model_id = name if "/" in name else f"sentence-transformers/{name}"
+        if not os.path.exists(os.path.join(path, QUANTIZED_MODEL_FILE)):
+            # Exportación y cuantización dinámica una sola vez; después se carga de disco
+            ORTModelForFeatureExtraction.from_pretrained(model_id, export=True).save_pretrained(path)
+            AutoTokenizer.from_pretrained(model_id).save_pretrained(path)
+            quantizer = ORTQuantizer.from_pretrained(path)
+            quantizer.quantize(
+                save_dir=path,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            )
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(path, file_name=QUANTIZED_MODEL_FILE)
+    
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        """Misma interfaz que SentenceTransformer.encode: mean pooling sobre los tokens"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                    return_tensors="np")
+            token_embeddings = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"][..., np.newaxis].astype(np.float32)
+            batches.append((token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        
+        embeddings = np.concatenate(batches).astype(np.float32)
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings[0] if single else embeddings
+
+@lru_cache(maxsize=None)
+def load_sentence_model(name: str):
+    """Sentence Transformer compartido por proceso: se carga una vez por nombre"""
+    if settings.ML_QUANTIZE:
+        try:
+            encoder = QuantizedSentenceEncoder(name, os.path.join(settings.ML_MODEL_PATH, "onnx", name.replace("/", "_")))
+            print("✅ Sentence Transformer int8 (ONNX Runtime) inicializado")
+            return encoder
+        except Exception as e:
+            print(f"⚠️ Modelo cuantizado no disponible, usando FP32: {e}")
+    return SentenceTransformer(name)
+
+@lru_cache(maxsize=1)
+def load_spacy_model():
+    """Modelo de spaCy compartido por proceso, con respaldo al inglés o a uno vacío"""
+    try:
+        nlp = spacy.load("es_core_news_sm")
+        print("✅ spaCy modelo español inicializado")
+    except OSError:
+        print("⚠️ Modelo spaCy español no encontrado, usando modelo básico")
+        try:
+            nlp = spacy.load("en_core_web_sm")
+        except:
+            print("⚠️ Usando modelo spaCy básico")
+            return spacy.blank("es")
+    
+    # Solo se usan las entidades: fuera tagger, parser, lematizador, etc. (tok2vec puede alimentar a ner)
+    nlp.select_pipes(enable=[name for name in nlp.pipe_names if name in SPACY_PIPES])
+    return nlp
 
 class MLService:
     """Servicio de Machine Learning para procesamiento de lenguaje natural"""
@@ -27,6 +148,17 @@ class MLService:
         self.intent_classifier = None
         self.emotion_classifier = None
         self.model_path = settings.ML_MODEL_PATH
+        self._context_cache: OrderedDict[bytes, Tuple[float, Dict[str, Any]]] = OrderedDict()
+        self._embedding_cache: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._embedding_lock = threading.Lock()
+        self._entity_cache: OrderedDict[str, List[Dict[str, str]]] = OrderedDict()
+        self._entity_lock = threading.Lock()
+        # Procesos de inferencia (ML_PROCESS_WORKERS); sin pool los análisis corren en hilos
+        self._pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        # Mensajes con los que se ajustó el TF-IDF y próxima comprobación de reajuste
+        self._tfidf_corpus_size = 0
+        self._tfidf_check_at = 0.0
+        self._tfidf_task: Optional[asyncio.Task] = None
         
         # Crear directorio de modelos si no existe
         os.makedirs(self.model_path, exist_ok=True)
@@ -45,43 +177,98 @@ class MLService:
         
         # Inicializar Sentence Transformer
         try:
-            self.sentence_model = SentenceTransformer(settings.SENTENCE_TRANSFORMER_MODEL)
+            self.sentence_model = load_sentence_model(settings.SENTENCE_TRANSFORMER_MODEL)
             print("✅ Sentence Transformer inicializado")
         except Exception as e:
             print(f"⚠️ Error inicializando Sentence Transformer: {e}")
         
         # Inicializar spaCy
-        try:
-            self.nlp = spacy.load("es_core_news_sm")
-            print("✅ spaCy modelo español inicializado")
-        except OSError:
-            print("⚠️ Modelo spaCy español no encontrado, usando modelo básico")
-            try:
-                self.nlp = spacy.load("en_core_web_sm")
-            except:
-                print("⚠️ Usando modelo spaCy básico")
-                self.nlp = spacy.blank("es")
+        self.nlp = load_spacy_model()
         
         # Inicializar TF-IDF
-        self.tfidf_vectorizer = TfidfVectorizer(
+        await self._load_or_fit_tfidf()
+        
+        # Cargar o crear clasificadores
+        self._load_classifiers()
+        
+        if settings.ML_PROCESS_WORKERS > 0:
+            # spawn: los procesos arrancan limpios, sin heredar torch ni los hilos del servidor
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=settings.ML_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker_models
+            )
+            print(f"✅ Pool de inferencia con {settings.ML_PROCESS_WORKERS} procesos")
+        
+        print("✅ Servicio ML inicializado correctamente")
+    
+    def _new_tfidf_vectorizer(self) -> TfidfVectorizer:
+        return TfidfVectorizer(
             max_features=1000,
             stop_words='english',
             ngram_range=(1, 2)
         )
+    
+    async def _load_or_fit_tfidf(self):
+        """Cargar el TF-IDF ajustado o ajustarlo con el historial de conversaciones"""
+        self._tfidf_check_at = time.monotonic() + TFIDF_REFIT_INTERVAL
+        tfidf_path = os.path.join(self.model_path, "tfidf_vectorizer.pkl")
+        if os.path.exists(tfidf_path):
+            try:
+                data = joblib.load(tfidf_path)
+                # Los ficheros antiguos guardan solo el vectorizador: se reajustará en la primera comprobación
+                if isinstance(data, dict):
+                    self.tfidf_vectorizer, self._tfidf_corpus_size = data["vectorizer"], data["corpus_size"]
+                else:
+                    self.tfidf_vectorizer, self._tfidf_corpus_size = data, 0
+                print("✅ Vectorizador TF-IDF cargado")
+                return
+            except:
+                pass
         
-        # Cargar o crear clasificadores
-        await self._load_or_create_classifiers()
+        self.tfidf_vectorizer = self._new_tfidf_vectorizer()
+        await self._refit_tfidf()
+    
+    async def _refit_tfidf(self):
+        """Ajustar el TF-IDF con el historial si el corpus creció lo suficiente desde el último ajuste"""
+        # Importación diferida: los procesos del pool de inferencia no abren la base de datos
+        from src.core.database import db_manager
         
-        print("✅ Servicio ML inicializado correctamente")
+        # El IDF solo tiene sentido sobre un corpus: con pocos mensajes se ajusta en una comprobación posterior
+        corpus = await asyncio.to_thread(db_manager.get_user_messages, TFIDF_CORPUS_SIZE)
+        if len(corpus) < TFIDF_MIN_CORPUS or len(corpus) < TFIDF_REFIT_GROWTH * self._tfidf_corpus_size:
+            return
+        
+        try:
+            vectorizer = self._new_tfidf_vectorizer()
+            await asyncio.to_thread(vectorizer.fit, corpus)
+            # Se sustituye de una vez: mientras tanto extract_keywords sigue con el anterior
+            self.tfidf_vectorizer = vectorizer
+            self._tfidf_corpus_size = len(corpus)
+            await asyncio.to_thread(
+                joblib.dump, {"vectorizer": vectorizer, "corpus_size": len(corpus)},
+                os.path.join(self.model_path, "tfidf_vectorizer.pkl")
+            )
+            print(f"✅ Vectorizador TF-IDF ajustado con {len(corpus)} mensajes")
+        except Exception as e:
+            print(f"⚠️ Error ajustando TF-IDF: {e}")
+    
+    def _schedule_tfidf_refit(self):
+        """Lanzar en segundo plano la comprobación de reajuste del TF-IDF, como mucho una por intervalo"""
+        now = time.monotonic()
+        if now < self._tfidf_check_at or (self._tfidf_task is not None and not self._tfidf_task.done()):
+            return
+        self._tfidf_check_at = now + TFIDF_REFIT_INTERVAL
+        self._tfidf_task = asyncio.create_task(self._refit_tfidf())
     
-    async def _load_or_create_classifiers(self):
+    def _load_classifiers(self):
         """Cargar o crear clasificadores"""
         # Intentar cargar clasificador de intenciones
         intent_model_path = os.path.join(self.model_path, "intent_classifier.pkl")
         if os.path.exists(intent_model_path):
             try:
-                with open(intent_model_path, 'rb') as f:
-                    self.intent_classifier = pickle.load(f)
+                # mmap: los arrays de numpy se leen bajo demanda y los workers comparten las páginas
+                self.intent_classifier = joblib.load(intent_model_path, mmap_mode='r')
                 print("✅ Clasificador de intenciones cargado")
             except:
                 self.intent_classifier = None
@@ -92,8 +279,7 @@ class MLService:
         emotion_model_path = os.path.join(self.model_path, "emotion_classifier.pkl")
         if os.path.exists(emotion_model_path):
             try:
-                with open(emotion_model_path, 'rb') as f:
-                    self.emotion_classifier = pickle.load(f)
+                self.emotion_classifier = joblib.load(emotion_model_path, mmap_mode='r')
                 print("✅ Clasificador de emociones cargado")
             except:
                 self.emotion_classifier = None
@@ -103,19 +289,65 @@ class MLService:
     async def analyze_context(self, message: str, 
                             conversation_history: List[Dict] = None) -> Dict[str, Any]:
         """Analizar contexto del mensaje"""
+        cache_key = self._context_cache_key(message, conversation_history)
+        cached = self._context_cache.get(cache_key)
+        if cached is not None:
+            cached_at, context = cached
+            if time.monotonic() - cached_at < CONTEXT_CACHE_TTL:
+                self._context_cache.move_to_end(cache_key)
+                return context
+            del self._context_cache[cache_key]
+        
+        self._schedule_tfidf_refit()
+        
+        # Los análisis con modelos corren en paralelo fuera del event loop (hilos o procesos);
+        # los que no tienen modelo cargado y los cálculos baratos se resuelven en línea
+        model_calls = {
+            "keywords": asyncio.to_thread(self.extract_keywords, message),
+            "entities": self._run_model("extract_entities", message)
+        }
+        if self.intent_classifier:
+            model_calls["intent"] = self._run_model("classify_intent", message)
+        if self.emotion_classifier:
+            model_calls["emotions"] = self._run_model("analyze_emotions", message)
+        if conversation_history and self.sentence_model:
+            # A los procesos solo viajan los textos que usa la similitud
+            recent = [{"user_message": msg.get("user_message")}
+                      for msg in conversation_history[-SIMILARITY_HISTORY_WINDOW:]]
+            model_calls["similarity"] = self._run_model("calculate_similarity", message, recent)
+        results = dict(zip(model_calls, await asyncio.gather(*model_calls.values())))
+        
         context = {
-            "intent": await self.classify_intent(message),
-            "emotions": await self.analyze_emotions(message),
-            "keywords": await self.extract_keywords(message),
-            "entities": await self.extract_entities(message),
-            "similarity": await self.calculate_similarity(message, conversation_history),
-            "complexity": await self.analyze_complexity(message),
-            "language": await self.detect_language(message)
+            "intent": results.get("intent") or self.classify_intent(message),
+            "emotions": results.get("emotions") or self.analyze_emotions(message),
+            "keywords": results["keywords"],
+            "entities": results["entities"],
+            "similarity": results.get("similarity") or self.calculate_similarity(message, conversation_history),
+            "complexity": self.analyze_complexity(message),
+            "language": self.detect_language(message)
         }
         
+        self._context_cache[cache_key] = (time.monotonic(), context)
+        if len(self._context_cache) > CONTEXT_CACHE_SIZE:
+            self._context_cache.popitem(last=False)
+        
         return context
     
-    async def classify_intent(self, text: str) -> Dict[str, Any]:
+    def _run_model(self, method: str, *args):
+        """Ejecutar un análisis en el pool de procesos, o en un hilo si no hay pool"""
+        if self._pool is None:
+            return asyncio.to_thread(getattr(self, method), *args)
+        return asyncio.get_running_loop().run_in_executor(self._pool, _run_worker_model, method, *args)
+    
+    def _context_cache_key(self, message: str, conversation_history: List[Dict] = None) -> bytes:
+        """Clave de caché: el mensaje y los mensajes del historial que usa la similitud"""
+        recent = [
+            msg.get("user_message")
+            for msg in (conversation_history or [])[-SIMILARITY_HISTORY_WINDOW:]
+        ]
+        return hashlib.blake2b(orjson.dumps([message, recent]), digest_size=16).digest()
+    
+    def classify_intent(self, text: str) -> Dict[str, Any]:
         """Clasificar intención del mensaje"""
         if not self.intent_classifier:
             return {"intent": "general", "confidence": 0.5}
@@ -124,64 +356,75 @@ class MLService:
             # Preprocesar texto
             processed_text = self._preprocess_text(text)
             
-            # Clasificar
-            prediction = self.intent_classifier.predict([processed_text])
-            confidence = max(self.intent_classifier.predict_proba([processed_text])[0])
+            # Clasificar: una sola llamada al modelo da la etiqueta y su probabilidad
+            proba = self.intent_classifier.predict_proba([processed_text])[0]
+            best = int(proba.argmax())
             
             return {
-                "intent": prediction[0],
-                "confidence": float(confidence)
+                "intent": str(self.intent_classifier.classes_[best]),
+                "confidence": float(proba[best])
             }
         except Exception as e:
             return {"intent": "general", "confidence": 0.5, "error": str(e)}
     
-    async def analyze_emotions(self, text: str) -> Dict[str, Any]:
+    def analyze_emotions(self, text: str) -> Dict[str, Any]:
         """Analizar emociones en el texto"""
         if not self.emotion_classifier:
             return {"emotions": ["neutral"], "confidence": 0.5}
         
         try:
             processed_text = self._preprocess_text(text)
-            prediction = self.emotion_classifier.predict([processed_text])
-            confidence = max(self.emotion_classifier.predict_proba([processed_text])[0])
+            proba = self.emotion_classifier.predict_proba([processed_text])[0]
+            best = int(proba.argmax())
+            prediction = str(self.emotion_classifier.classes_[best])
             
             return {
-                "emotions": prediction[0].split(",") if "," in prediction[0] else [prediction[0]],
-                "confidence": float(confidence)
+                "emotions": prediction.split(",") if "," in prediction else [prediction],
+                "confidence": float(proba[best])
             }
         except Exception as e:
             return {"emotions": ["neutral"], "confidence": 0.5, "error": str(e)}
     
-    async def extract_keywords(self, text: str) -> List[str]:
+    def extract_keywords(self, text: str) -> List[str]:
         """Extraer palabras clave usando TF-IDF"""
         try:
             if not self.tfidf_vectorizer:
                 return []
             
-            # Ajustar vectorizador si es necesario
-            if not hasattr(self.tfidf_vectorizer, 'vocabulary_'):
-                self.tfidf_vectorizer.fit([text])
-            
-            # Vectorizar texto
-            tfidf_matrix = self.tfidf_vectorizer.transform([text])
-            feature_names = self.tfidf_vectorizer.get_feature_names_out()
+            vectorizer = self.tfidf_vectorizer
+            if not hasattr(vectorizer, 'vocabulary_'):
+                # Sin corpus todavía: un vectorizador desechable para este texto (equivale a frecuencias)
+                vectorizer = self._new_tfidf_vectorizer()
+                vectorizer.fit([text])
             
-            # Obtener palabras con mayor TF-IDF
-            scores = tfidf_matrix.toarray()[0]
-            top_indices = np.argsort(scores)[-10:][::-1]  # Top 10
+            # Vectorizar texto: la fila es dispersa, solo se recorren los términos presentes
+            row = vectorizer.transform([text])
+            if row.nnz == 0:
+                return []
+            feature_names = vectorizer.get_feature_names_out()
             
-            keywords = [feature_names[i] for i in top_indices if scores[i] > 0]
-            return keywords[:5]  # Top 5
+            # Top 5 con argpartition (O(nnz)) y orden solo de esos 5
+            k = min(5, row.nnz)
+            top = np.argpartition(-row.data, k - 1)[:k]
+            top = top[np.argsort(-row.data[top])]
+            return [feature_names[i] for i in row.indices[top]]
             
         except Exception as e:
             return []
     
-    async def extract_entities(self, text: str) -> List[Dict[str, str]]:
+    def extract_entities(self, text: str) -> List[Dict[str, str]]:
         """Extraer entidades nombradas"""
         try:
             if not self.nlp:
                 return []
             
+            # Mismo texto, mismas entidades: se evita repetir el pipeline
+            with self._entity_lock:
+                cached = self._entity_cache.get(text)
+                if cached is not None:
+                    self._entity_cache.move_to_end(text)
+                    return cached
+            
             doc = self.nlp(text)
             entities = []
             
@@ -192,30 +435,37 @@ class MLService:
                     "confidence": 0.8  # spaCy no proporciona confianza por defecto
                 })
             
+            with self._entity_lock:
+                self._entity_cache[text] = entities
+                if len(self._entity_cache) > ENTITY_CACHE_SIZE:
+                    self._entity_cache.popitem(last=False)
+            
             return entities
             
         except Exception as e:
             return []
     
-    async def calculate_similarity(self, message: str, 
+    def calculate_similarity(self, message: str, 
                                  conversation_history: List[Dict] = None) -> Dict[str, Any]:
         """Calcular similitud con mensajes anteriores"""
         if not conversation_history or not self.sentence_model:
             return {"similarity": 0.0, "most_similar": None}
         
         try:
-            # Obtener embeddings
-            current_embedding = self.sentence_model.encode([message])
+            history_messages = [msg["user_message"] for msg in conversation_history[-SIMILARITY_HISTORY_WINDOW:]
+                                if msg.get("user_message")]
+            if not history_messages:
+                return {"similarity": 0.0, "most_similar": None}
+            
+            # Un solo encode por lotes: el mensaje actual y los del historial que no estén en caché
+            embeddings = self._embed_batch([message, *history_messages])
+            # Embeddings normalizados: el producto punto es la similitud coseno
+            scores = embeddings[1:] @ embeddings[0]
             
-            similarities = []
-            for msg in conversation_history[-5:]:  # Últimos 5 mensajes
-                if msg.get("user_message"):
-                    hist_embedding = self.sentence_model.encode([msg["user_message"]])
-                    similarity = cosine_similarity(current_embedding, hist_embedding)[0][0]
-                    similarities.append({
-                        "message": msg["user_message"],
-                        "similarity": float(similarity)
-                    })
+            similarities = [
+                {"message": text, "similarity": score}
+                for text, score in zip(history_messages, scores.tolist())
+            ]
             
             if similarities:
                 most_similar = max(similarities, key=lambda x: x["similarity"])
@@ -231,16 +481,52 @@ class MLService:
         except Exception as e:
             return {"similarity": 0.0, "most_similar": None, "error": str(e)}
     
-    async def analyze_complexity(self, text: str) -> Dict[str, Any]:
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        """Embeddings normalizados, codificando en un solo lote solo los textos sin caché"""
+        keys = [hashlib.blake2b(text.encode(), digest_size=16).digest() for text in texts]
+        # Se llama desde hilos (analyze_context): la caché solo se toca con el lock
+        found = {}
+        missing = {}
+        with self._embedding_lock:
+            for key, text in zip(keys, texts):
+                embedding = self._embedding_cache.get(key)
+                if embedding is None:
+                    missing[key] = text
+                else:
+                    self._embedding_cache.move_to_end(key)
+                    found[key] = embedding
+        
+        encoded = {}
+        if missing:
+            encoded = dict(zip(missing.keys(), self.sentence_model.encode(
+                list(missing.values()),
+                batch_size=len(missing),
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )))
+        
+        if encoded:
+            with self._embedding_lock:
+                self._embedding_cache.update(encoded)
+                while len(self._embedding_cache) > EMBEDDING_CACHE_SIZE:
+                    self._embedding_cache.popitem(last=False)
+        
+        # El resultado sale de las copias locales: otro hilo puede desalojar claves entre los dos locks
+        found.update(encoded)
+        return np.stack([found[key] for key in keys])
+    
+    def analyze_complexity(self, text: str) -> Dict[str, Any]:
         """Analizar complejidad del texto"""
         try:
-            # Métricas básicas
-            word_count = len(text.split())
-            sentence_count = len(re.split(r'[.!?]+', text))
+            # Métricas básicas: el texto se separa en palabras una sola vez
+            words = text.split()
+            word_count = len(words)
+            # Tantas frases como separadores más una (lo mismo que contar los trozos de split)
+            sentence_count = len(SENTENCE_SPLIT_RE.findall(text)) + 1
             avg_sentence_length = word_count / max(sentence_count, 1)
             
-            # Análisis de vocabulario
-            unique_words = len(set(text.lower().split()))
+            # Análisis de vocabulario sobre las mismas palabras, sin volver a recorrer el texto
+            unique_words = len({word.lower() for word in words})
             vocabulary_richness = unique_words / max(word_count, 1)
             
             # Nivel de complejidad (0-1)
@@ -258,14 +544,12 @@ class MLService:
         except Exception as e:
             return {"complexity_score": 0.5, "level": "medium", "error": str(e)}
     
-    async def detect_language(self, text: str) -> Dict[str, Any]:
+    def detect_language(self, text: str) -> Dict[str, Any]:
         """Detectar idioma del texto"""
         try:
             # Análisis básico de idioma
-            spanish_indicators = ["el", "la", "de", "que", "y", "en", "un", "es", "se", "no", "te", "lo", "le", "da", "su", "por", "son", "con", "para", "al", "del", "los", "las", "una", "pero", "sus", "más", "como", "todo", "esta", "sobre", "entre", "cuando", "muy", "sin", "hasta", "desde", "está", "mi", "porque", "qué", "sólo", "han", "yo", "hay", "vez", "puede", "todos", "así", "nos", "ni", "parte", "tiene", "él", "uno", "donde", "bien", "tiempo", "mismo", "ese", "ahora", "cada", "e", "vida", "otro", "después", "te", "otros", "aunque", "esa", "esos", "estas", "me", "antes", "estado", "contra", "sí", "sino", "forma", "caso", "nada", "hacer", "general", "pero", "menos", "año", "mundo", "aquí", "manera", "tanto", "cual", "mientras", "saber", "hasta", "donde", "durante", "través", "tanto", "tanto", "tanto"]
-            
             words = text.lower().split()
-            spanish_word_count = sum(1 for word in words if word in spanish_indicators)
+            spanish_word_count = sum(1 for word in words if word in SPANISH_WORDS)
             spanish_ratio = spanish_word_count / max(len(words), 1)
             
             if spanish_ratio > 0.1:
@@ -290,10 +574,10 @@ class MLService:
         text = text.lower()
         
         # Remover caracteres especiales
-        text = re.sub(r'[^a-zA-Záéíóúñü\s]', '', text)
+        text = NON_WORD_RE.sub('', text)
         
         # Remover espacios extra
-        text = re.sub(r'\s+', ' ', text).strip()
+        text = WHITESPACE_RE.sub(' ', text).strip()
         
         return text
     
@@ -309,7 +593,9 @@ class MLService:
     async def train_intent_classifier(self, training_data: List[Dict[str, Any]]):
         """Entrenar clasificador de intenciones"""
         try:
-            from sklearn.ensemble import RandomForestClassifier
+            from sklearn.feature_extraction.text import HashingVectorizer
+            from sklearn.linear_model import LogisticRegression
+            from sklearn.pipeline import make_pipeline
             
             texts = [item["text"] for item in training_data]
             labels = [item["intent"] for item in training_data]
@@ -317,17 +603,21 @@ class MLService:
             # Preprocesar textos
             processed_texts = [self._preprocess_text(text) for text in texts]
             
-            # Vectorizar
-            X = self.tfidf_vectorizer.fit_transform(processed_texts)
-            
-            # Entrenar clasificador
-            self.intent_classifier = RandomForestClassifier(n_estimators=100, random_state=42)
-            self.intent_classifier.fit(X, labels)
+            # Características con hashing (sin vocabulario que guardar) y un modelo lineal:
+            # predecir es un producto disperso en lugar de recorrer cien árboles.
+            # El vectorizador va dentro del pipeline, así classify_intent recibe el texto directamente
+            classifier = make_pipeline(
+                HashingVectorizer(n_features=2**18, alternate_sign=False, ngram_range=(1, 2)),
+                LogisticRegression(max_iter=200)
+            )
+            await asyncio.to_thread(classifier.fit, processed_texts, labels)
+            # Se instala ya ajustado: las predicciones concurrentes siguen con el anterior mientras tanto
+            self.intent_classifier = classifier
             
             # Guardar modelo
             model_path = os.path.join(self.model_path, "intent_classifier.pkl")
-            with open(model_path, 'wb') as f:
-                pickle.dump(self.intent_classifier, f)
+            # Sin compresión: los arrays quedan alineados en el fichero y se pueden mapear en memoria
+            joblib.dump(classifier, model_path, compress=0)
             
             print("✅ Clasificador de intenciones entrenado y guardado")
             
@@ -336,8 +626,38 @@ class MLService:
     
     async def cleanup(self):
         """Limpiar recursos"""
-        # Liberar memoria de modelos
-        if self.sentence_model:
-            del self.sentence_model
-        if self.nlp:
-            del self.nlp
+        if self._tfidf_task is not None:
+            self._tfidf_task.cancel()
+        
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        
+        # Los modelos viven en las cachés del módulo: solo se sueltan las referencias
+        self.sentence_model = None
+        self.nlp = None
+
+# Servicio propio de cada proceso del pool de inferencia
+_worker_service: Optional["MLService"] = None
+
+def _init_worker_models():
+    """Cargar spaCy, el Sentence Transformer y los clasificadores una vez por proceso"""
+    global _worker_service
+    # Solo los modelos de inferencia: sin TF-IDF, sin pool propio y sin base de datos
+    service = MLService()
+    try:
+        service.sentence_model = load_sentence_model(settings.SENTENCE_TRANSFORMER_MODEL)
+    except Exception as e:
+        print(f"⚠️ Error inicializando Sentence Transformer en el proceso de inferencia: {e}")
+    service.nlp = load_spacy_model()
+    service._load_classifiers()
+    _worker_service = service
+
+def _run_worker_model(method: str, *args):
+    """Análisis dentro del proceso: recibe textos y devuelve dicts y listas serializables"""
+    return getattr(_worker_service, method)(*args)
+
+@lru_cache(maxsize=1)
+def get_ml_service() -> MLService:
+    """Instancia única del servicio de ML: los modelos se cargan una sola vez"""
+    return MLService()
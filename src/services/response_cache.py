@@ -0,0 +1,157 @@
+"""
+Cachés de respuestas de IA
+"""
+
+import os
+import time
+import logging
+import hashlib
+import msgspec
+import orjson
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+log = logging.getLogger("lenrodai.cache")
+
+class ExactResponseCache:
+    """Caché exacta de respuestas con expiración y tamaño máximo"""
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[str, Tuple[float, Dict[str, Any]]] = OrderedDict()
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """Clave estable para la combinación de historial, mensaje y parámetros del modelo"""
+        return hashlib.blake2b(orjson.dumps(list(parts)), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+class SemanticResponseCache:
+    """Caché semántica: reutiliza respuestas de mensajes con significado equivalente"""
+
+    def __init__(self, threshold: float = 0.9, maxsize: int = 5000, target_quality: float = 0.8,
+                 step: float = 0.02, min_threshold: float = 0.80, max_threshold: float = 0.99):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        # Búfer circular de capacidad fija: se reserva con el primer embedding y cada alta
+        # escribe una fila en self.next, sobrescribiendo la más antigua cuando está lleno
+        self.embeddings: Optional[np.ndarray] = None
+        self.responses: List[Dict[str, Any]] = []
+        # Modelo de cada fila, en paralelo a embeddings: el filtro por modelo es una comparación vectorizada
+        self.models = np.empty(maxsize, dtype=object)
+        self.next = 0
+        # Ajuste del umbral con la valoración de los usuarios (record_feedback)
+        self.target_quality = target_quality
+        self.step = step
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.rated_hits = 0
+        self.high_quality_hits = 0
+
+    def lookup(self, embedding: np.ndarray, model: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Buscar la respuesta del mensaje más parecido si supera el umbral (solo del modelo indicado)"""
+        if not self.responses:
+            return None
+
+        # Los embeddings están normalizados: el producto punto es la similitud coseno
+        similarities = self.embeddings[:len(self.responses)] @ embedding
+        if model is not None:
+            similarities = np.where(self.models[:len(self.responses)] == model, similarities, -np.inf)
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+            return self.responses[best]
+        return None
+
+    def add(self, embedding: np.ndarray, response: Dict[str, Any]):
+        """Guardar una respuesta junto al embedding de su mensaje"""
+        if self.embeddings is None:
+            self.embeddings = np.empty((self.maxsize, embedding.shape[0]), dtype=np.float32)
+        self.embeddings[self.next] = embedding
+        self.models[self.next] = response.get("model")
+        if len(self.responses) < self.maxsize:
+            self.responses.append(response)
+        else:
+            self.responses[self.next] = response
+        self.next = (self.next + 1) % self.maxsize
+
+    def _chronological(self) -> List[int]:
+        """Índices de las filas de la más antigua a la más reciente"""
+        size = len(self.responses)
+        if size < self.maxsize:
+            return list(range(size))
+        return [*range(self.next, size), *range(self.next)]
+
+    def record_feedback(self, helpful: bool):
+        """Ajustar el umbral según la calidad observada de los aciertos"""
+        self.rated_hits += 1
+        if helpful:
+            self.high_quality_hits += 1
+
+        quality = self.high_quality_hits / self.rated_hits
+        if quality < self.target_quality:
+            self.threshold = min(self.max_threshold, self.threshold + self.step)
+        else:
+            self.threshold = max(self.min_threshold, self.threshold - self.step)
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.responses),
+            "threshold": self.threshold,
+            "rated_hits": self.rated_hits,
+            "high_quality_hits": self.high_quality_hits
+        }
+
+    def load(self, path: str):
+        """Cargar la caché guardada en disco, si existe"""
+        # Sin pickle: la matriz en .npy y las respuestas en msgpack, que no ejecutan código al leerse
+        embeddings_path, responses_path = f"{path}.npy", f"{path}.msgpack"
+        if not (os.path.exists(embeddings_path) and os.path.exists(responses_path)):
+            return
+        try:
+            embeddings = np.load(embeddings_path, allow_pickle=False)
+            with open(responses_path, 'rb') as f:
+                responses = msgspec.msgpack.decode(f.read())
+            if len(responses) != len(embeddings):
+                raise ValueError("embeddings y respuestas no coinciden")
+            # Se guardan en orden cronológico: si sobran, se conservan las más recientes
+            embeddings, responses = embeddings[-self.maxsize:], responses[-self.maxsize:]
+            self.embeddings = np.empty((self.maxsize, embeddings.shape[1]), dtype=np.float32)
+            self.embeddings[:len(responses)] = embeddings
+            self.responses = responses
+            self.models[:len(responses)] = [response.get("model") for response in responses]
+            self.next = len(responses) % self.maxsize
+        except Exception as e:
+            log.warning("Error cargando caché semántica: %s", e)
+
+    def save(self, path: str):
+        """Guardar la caché en disco para el próximo arranque"""
+        if not self.responses:
+            return
+        try:
+            order = self._chronological()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            np.save(f"{path}.npy", self.embeddings[order], allow_pickle=False)
+            with open(f"{path}.msgpack", 'wb') as f:
+                f.write(msgspec.msgpack.encode([self.responses[i] for i in order]))
+        except Exception as e:
+            log.warning("Error guardando caché semántica: %s", e)
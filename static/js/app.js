@@ -5,6 +5,7 @@ class ChatApp {
             isConnected: false,
             isTyping: false,
             messages: [],
+            streamingMessage: null,
             conversations: [],
             settings: {
                 theme: 'light',
@@ -144,6 +145,14 @@ class ChatApp {
             this.handleTypingIndicator(data);
         });
         
+        this.websocketManager.on('delta', (data) => {
+            this.handleStreamDelta(data);
+        });
+        
+        this.websocketManager.on('done', (data) => {
+            this.handleStreamDone(data);
+        });
+        
         
         window.addEventListener('beforeunload', (e) => {
             if (this.state.messages.length > 0) {
@@ -243,7 +252,8 @@ class ChatApp {
         
         
         if (this.state.isConnected) {
-            this.websocketManager.sendTyping(true);
+            const messageInput = document.getElementById('messageInput');
+            this.websocketManager.sendTyping(true, messageInput.value, this.state.currentSessionId);
         }
     }
     
@@ -323,7 +333,38 @@ class ChatApp {
         this.ui.scrollToBottom();
     }
     
+    handleStreamDelta(data) {
+        // Primer fragmento: se crea el mensaje y se va completando en el sitio
+        if (!this.state.streamingMessage) {
+            this.ui.hideTypingIndicator();
+            this.state.streamingMessage = {
+                id: this.generateMessageId(),
+                type: 'assistant',
+                content: '',
+                timestamp: new Date().toISOString()
+            };
+            this.ui.addMessage(this.state.streamingMessage);
+        }
+        
+        this.state.streamingMessage.content += data.content;
+        this.ui.updateMessageContent(this.state.streamingMessage.id, this.state.streamingMessage.content);
+    }
+    
+    handleStreamDone(data) {
+        const aiMessage = this.state.streamingMessage;
+        this.state.streamingMessage = null;
+        if (!aiMessage) return;
+        
+        aiMessage.timestamp = data.timestamp;
+        aiMessage.context = data.context;
+        aiMessage.modelInfo = data.model_info;
+        
+        this.state.messages.push(aiMessage);
+        this.updateConversationList();
+    }
+    
     handleError(data) {
+        this.state.streamingMessage = null;
         this.ui.hideTypingIndicator();
         this.ui.showError(data.message);
     }
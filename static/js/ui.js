@@ -53,6 +53,14 @@ class UI {
         }, 10);
     }
     
+    updateMessageContent(messageId, content) {
+        const text = document.querySelector(`[data-message-id="${messageId}"] .message-text`);
+        if (!text) return;
+        
+        text.innerHTML = this.formatMessage(content);
+        this.scrollToBottom();
+    }
+    
     createMessageElement(message) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${message.type}`;
@@ -9,6 +9,7 @@ class WebSocketManager {
         this.messageQueue = [];
         this.heartbeatInterval = null;
         this.heartbeatTimeout = null;
+        this.textDecoder = new TextDecoder();
     }
     
     async connect() {
@@ -25,6 +26,7 @@ class WebSocketManager {
             console.log('Conectando a WebSocket:', wsUrl);
             
             this.ws = new WebSocket(wsUrl);
+            this.ws.binaryType = 'arraybuffer';
             
             this.ws.onopen = (event) => {
                 console.log('WebSocket conectado');
@@ -37,8 +39,13 @@ class WebSocketManager {
             
             this.ws.onmessage = (event) => {
                 try {
-                    const data = JSON.parse(event.data);
-                    this.handleMessage(data);
+                    const data = this.parseFrame(event.data);
+                    // El servidor puede agrupar varios mensajes en un solo frame
+                    if (Array.isArray(data)) {
+                        data.forEach(message => this.handleMessage(message));
+                    } else {
+                        this.handleMessage(data);
+                    }
                 } catch (error) {
                     console.error('Error parseando mensaje WebSocket:', error);
                 }
@@ -98,11 +105,14 @@ class WebSocketManager {
         }
     }
     
-    sendTyping(isTyping) {
+    sendTyping(isTyping, partialText = '', sessionId = null) {
         this.sendMessage({
             type: 'typing',
             is_typing: isTyping,
-            user_id: this.getUserId()
+            user_id: this.getUserId(),
+            // El servidor adelanta la respuesta con el texto parcial
+            partial_text: partialText,
+            session_id: sessionId
         });
     }
     
@@ -121,6 +131,14 @@ class WebSocketManager {
                 this.emit('message', data);
                 break;
                 
+            case 'delta':
+                this.emit('delta', data);
+                break;
+                
+            case 'done':
+                this.emit('done', data);
+                break;
+                
             case 'error':
                 this.emit('error', data);
                 break;
@@ -147,6 +165,12 @@ class WebSocketManager {
         }
     }
     
+    parseFrame(data) {
+        // El servidor envía JSON como frames binarios (UTF-8)
+        const text = typeof data === 'string' ? data : this.textDecoder.decode(data);
+        return JSON.parse(text);
+    }
+    
     isConnected() {
         return this.ws && this.ws.readyState === WebSocket.OPEN;
     }
@@ -327,6 +351,7 @@ class AdminWebSocketManager extends WebSocketManager {
             console.log('Conectando a WebSocket de administración:', wsUrl);
             
             this.ws = new WebSocket(wsUrl);
+            this.ws.binaryType = 'arraybuffer';
             
             this.ws.onopen = (event) => {
                 console.log('WebSocket de administración conectado');
@@ -338,8 +363,12 @@ class AdminWebSocketManager extends WebSocketManager {
             
             this.ws.onmessage = (event) => {
                 try {
-                    const data = JSON.parse(event.data);
-                    this.handleAdminMessage(data);
+                    const data = this.parseFrame(event.data);
+                    if (Array.isArray(data)) {
+                        data.forEach(message => this.handleAdminMessage(message));
+                    } else {
+                        this.handleAdminMessage(data);
+                    }
                 } catch (error) {
                     console.error('Error parseando mensaje de administración:', error);
                 }